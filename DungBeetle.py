@@ -4,20 +4,28 @@ import base64
 import numpy as np
 import pandas as pd
 import pkg_resources
+from tools import spool
 
 session = st.session_state
 
 def callback_upload():
     st.session_state["file_name"] = st.session_state["uploaded_file"].name
     st.session_state["is_file_uploaded"] = True
-    st.session_state["array_buffer"] = st.session_state["uploaded_file"].getvalue()
-    st.session_state["ifc_file"] = ifcopenshell.file.from_string(st.session_state["uploaded_file"].getvalue().decode("utf-8"))
+    # Parsed from a spool file on disk once per file content, sessions uploading the same file share the model
+    # The session keeps the content hash, the model is fetched from the cache when it's used
+    st.session_state["model_hash"], st.session_state["ifc_path"] = spool.open_upload(
+        st.session_state["uploaded_file"], st.session_state.get("ifc_path")
+        )
 
 def get_project_name():
-    return st.session_state["ifc_file"].by_type("IfcProject")[0].Name
+    model = spool.get_session_model(st.session_state)
+    with model.lock:
+        return model.ifc_file.by_type("IfcProject")[0].Name
 
 def change_project_name():
-    st.session_state["ifc_file"].by_type("IfcProject")[0].Name = st.session_state["project_name_input"]
+    model = spool.get_session_model(st.session_state)
+    with model.lock:
+        model.ifc_file.by_type("IfcProject")[0].Name = st.session_state["project_name_input"]
 
 @st.cache_data
 def load_video(url):
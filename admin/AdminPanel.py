@@ -13,15 +13,17 @@ import sys
 sys.path.append("../")
 sys.path.append("./vendor/")
 
-from geopy.extra.rate_limiter import RateLimiter
-from geopy.geocoders import Nominatim
-from google.cloud import storage
 from google.oauth2.service_account import Credentials
 from ifcopenshell.util.shape import get_bbox, get_vertices
 from tools.BoundingBox import *
+from tools import explode
+from tools import fingerprint
+from tools import geocoding
 from tools import ifchelper
+from tools import ingest
+from tools import storage
+from tools import uploader
 from tools.ifchelper import get_material_psets
-from vendor import ifcpatch
 
 
 # ========== Initialize session states ==========
@@ -148,10 +150,11 @@ if not credentials:
 
 # Now you can use `credentials` in your code
 
-# ========== Create a Google Cloud Storage client ==========
+# ========== Storage backend ==========
 
 # credentials = Credentials.from_service_account_info(st.secrets["GOOGLE_APPLICATION_CREDENTIALS"]) -> This code worked with StreamlitCloud
-storage_client = storage.Client(credentials=credentials)
+# GCS by default, DUNGBEETLE_STORAGE=local:<directory> runs the panel without cloud access
+storage_backend = storage.get_storage(credentials)
 
 # ========== Functions ==========
 # === IFC Schema ===
@@ -166,38 +169,24 @@ def get_ifc_schema(ifc_file):
 
 # === Get object properties & material data ===
 
-def get_objects_data_by_class(file, class_type):
+def get_objects_data_by_class(file, class_type, index=None):
+    if index is None:
+        index = ifchelper.get_relationship_index(file)
     objects_data = []
     objects = file.by_type(class_type)
-    for object in objects:       
-        objects_data.append({
-                "Express ID": object.id(),
-                "Global ID": object.GlobalId,
-                "Parent's GUID": Element.get_aggregate(object).GlobalId
-                if Element.get_aggregate(object)
-                else "",             
-                "Class": object.is_a(),
-                "PredefinedType": Element.get_predefined_type(object),
-                "Name": object.Name,
-                "Level": Element.get_container(object).Name
-                if Element.get_container(object)
-                else "",
-                "ObjectType": Element.get_type(object).Name
-                if Element.get_type(object)
-                else "",                  
-                "QuantitySets": Element.get_psets(object, qtos_only=True),
-                "PropertySets": Element.get_psets(object, psets_only=True),
-                "Material": Element.get_material(object).Name
-                if Element.get_material(object)
-                else get_parts_material_data(object), 
-                "MaterialPsets": get_material_psets(object)
-                if Element.get_material(object)
-                else "",         
-                
-        })       
+    for object in objects:
+        objects_data.append(get_object_data(file, object, index))
     return objects_data
 
 
+def get_object_data(file, object, index):
+    object_data = ifchelper.get_object_data(file, object, index)
+    # Elements without their own material get the material names of their parts
+    if not ifchelper.get_indexed_material(index, object):
+        object_data["Material"] = get_parts_material_data(object)
+    return object_data
+
+
 def get_parts_material_data(element):
     material_names = set()  # Using a set to avoid duplicate material names
 
@@ -247,13 +236,16 @@ def display_project_address(building_ID, street, post_code, town, canton, countr
     st.write("Complete address: " + complete_address)
 
 
-def get_project_geocoordinates(complete_address):
-    locator = Nominatim(user_agent="OpenMapQuest")
-    geocode = RateLimiter(locator.geocode, min_delay_seconds=1)
-    
-    if complete_address is not None: 
-        location = geocode(complete_address)
-        point = tuple(location.point) if location else (np.nan, np.nan, np.nan)
+def get_project_geocoordinates(complete_address, ifc_file=None):
+    if ifc_file is not None:
+        # Use the georeferencing of IfcSite when the file has it, geocode the address otherwise
+        point = geocoding.get_project_point(ifc_file, complete_address)
+        latitude = point[0]
+        longitude = point[1]
+
+    elif complete_address is not None: 
+        # Cached per address, so reruns of this page don't call the geocoder again
+        point = geocoding.geocode_address(complete_address)
         
         # Get the lat lon and alt for later inclusion in DataFrame
         latitude = point[0]
@@ -297,6 +289,8 @@ def input_address():
 
 def display_coordinates_and_map():
     st.write("Dung Beetle calculated your project's coordinates:")
+    geocode_statistics = geocoding.get_geocode_cache().get_statistics()
+    st.caption(f"Geocoding cache: {geocode_statistics['hits']} hits, {geocode_statistics['misses']} misses")
     st.dataframe(df_geo_coordinates, hide_index=True)
     st.write("Please review the map to check if the location is correct - if not, correct your address.")
     st.map(df_geo_coordinates)
@@ -313,70 +307,12 @@ def list_of_IfcEntities_from_CSV(csv_file_name):
     return csv_entities
 
 
-# === Extract building products and save as independent components ===
-
-def move_to_origin(ifc_file, guid):
-    part = ifc_file.by_guid(guid)
-    new_matrix = np.eye(4)
-    ifcopenshell.api.run("geometry.edit_object_placement", ifc_file, product=part, matrix=new_matrix)
-    return ifc_file
-
-def move_storey_to_origin(ifc_file, storey):
-    new_matrix = np.eye(4)
-    storey.Name = "Floor plan"
-    ifcopenshell.api.run("geometry.edit_object_placement", ifc_file, product=storey, matrix=new_matrix)
-    return ifc_file
-
-def move_site_origin_to_000(ifc_file):
-    site = ifc_file.by_type("IfcSite")[0]
-    new_matrix = np.eye(4)
-    ifcopenshell.api.run("geometry.edit_object_placement", ifc_file, product=site, matrix=new_matrix)
-    return ifc_file
-
-def move_building_origin_to_000(ifc_file):
-    building = ifc_file.by_type("IfcBuilding")[0]
-    building.Name = "Dung Beetle - Digital Material Warehouse"
-    new_matrix = np.eye(4)
-    ifcopenshell.api.run("geometry.edit_object_placement", ifc_file, product=building, matrix=new_matrix)
-    return ifc_file
-
-def change_project_name(ifc_file):
-    project = ifc_file.by_type("IfcProject")[0]
-    project.Name = "Dung Beetle - Digital Material Warehouse"
-    return ifc_file
-
-def change_site_name(ifc_file):
-    site = ifc_file.by_type("IfcSite")[0]
-    site.Name = "Dung Beetle - Digital Material Warehouse"
-    return ifc_file
-
-def extract_and_save_element(ifc_file, guid, save_dir, original_filename):
-    extracted_ifc = ifcpatch.execute({"input": ifc_file, "file": ifc_file, "recipe": "ExtractElements", "arguments": [f"{guid}"]})
-    extracted_ifc = move_to_origin(extracted_ifc, guid)
-    extracted_ifc = move_site_origin_to_000(extracted_ifc)
-    extracted_ifc = move_building_origin_to_000(extracted_ifc)
-    extracted_ifc = change_project_name(extracted_ifc)
-    extracted_ifc = change_site_name(extracted_ifc)
-    # Adjust IfcStorey - move to 0,0,0 and rename to "Floor plans"
-    z_min = 0.0  # Storey elevation we want to move our extracted file
-    storey = extracted_ifc.by_type("IfcBuildingStorey")[0]
-    extracted_ifc = move_storey_to_origin(extracted_ifc, storey)
-    # Ensure the bottom edge of storey is located at 0,0
-    storey.Elevation = z_min
-    temp_file_path = os.path.join(save_dir, f"{original_filename}_{guid}.ifc")
-    extracted_file_name = f"{original_filename}_{guid}.ifc"
-    extracted_ifc.write(temp_file_path)
-    return temp_file_path, extracted_file_name  # Return the path of the saved file
-
-
 # ========== Google Cloud Storage Functions ==========
 
 # ... (previous code for setting up Google Cloud Storage and Streamlit elements)
 
 def upload_blob(bucket_name, source_file_name, destination_blob_name):
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(source_file_name)
+    storage_backend.put_file(bucket_name, destination_blob_name, source_file_name)
 
 
 # ========== Main app ==========
@@ -405,7 +341,7 @@ if uploaded_file:
         proceed_to_step_6 = False
         building_ID, street, post_code, town, canton, country, complete_address = get_project_address(ifc_file)
         display_project_address(building_ID, street, post_code, town, canton, country, complete_address)
-        df_geo_coordinates = get_project_geocoordinates(complete_address)
+        df_geo_coordinates = get_project_geocoordinates(complete_address, ifc_file)
         coordinates_invalid = validate_geo_coordinates(df_geo_coordinates)
         if coordinates_invalid == True:
             st.warning("""Your address is faulty or incomplete, Dung Beetle cannot find project coordinates.
@@ -438,10 +374,13 @@ if uploaded_file:
             ifcEntity4_dataframes = {}       
             with st.spinner("Getting Property & Quantity Set data for all objects sorted by IfcEntity"):
                 time.sleep(1)
+                # One pass over the file extracts object data and dimensions of every IfcEntity in the CSV
+                entity_dataframes, entity_dimension_rows = ingest.ingest_elements(
+                    ifc_file, IfcEntities4, get_object_data=get_object_data
+                    )
                 for entity in IfcEntities4:
                     ifcEntity4_dataframes["temp_" + entity] = pd.DataFrame()           
-                    warehouse_data = get_objects_data_by_class(ifc_file, entity)
-                    generated_df = ifchelper.create_pandas_dataframe(warehouse_data)
+                    generated_df = entity_dataframes[entity]
                     rows, cols = generated_df.shape
                     if rows > 0:
                         st.write(f"{entity} DataFrame has {rows} items and {cols} properties.")
@@ -455,7 +394,7 @@ if uploaded_file:
                 length_unit, conversion_factor = get_length_unit_and_conversion_factor(ifc_file)
                 conversion_factor = display_ifc_project_units(conversion_factor, length_unit)
                 for entity in IfcEntities4:
-                    dimensions_df = get_bounding_box_dimensions(ifc_file, entity, conversion_factor)
+                    dimensions_df = create_dimensions_dataframe(entity_dimension_rows[entity], conversion_factor)
                     dim_rows, dim_cols = dimensions_df.shape
                     if dim_rows > 0:
                         st.write(f"{entity} DataFrame has {dim_rows} items and {dim_cols} properties.")
@@ -476,11 +415,10 @@ if uploaded_file:
                     with col2:
                         st.write("""If you've carefully examined the content of the dataframe and found it to be in line with the standards set by Dung Beetle, 
                                  click the APPROVE button. By doing so, your dataset will be incorporated into the primary database.""")
+                        upload_concurrency = st.number_input("Parallel uploads", min_value=1, max_value=64, value=uploader.UPLOAD_CONCURRENCY)
                         if st.button("APPROVE"):
-                            bucket_name = 'ifc_warehouse'
-                            bucket = storage_client.bucket(bucket_name)                    
-                            blob = bucket.blob(f"{folder_name}/")
-                            blob.upload_from_string('', content_type='application/x-www-form-urlencoded;charset=UTF-8')
+                            bucket_name = storage.IFC_WAREHOUSE_BUCKET
+                            storage_backend.put(bucket_name, f"{folder_name}/", '', content_type='application/x-www-form-urlencoded;charset=UTF-8')
                             proceed_to_step_6 = True
 
                         
@@ -512,19 +450,74 @@ if uploaded_file:
                         for elem in all_elements:
                             unique_element_types.add(elem.is_a())
 
-                        # Loop through each unique IfcElement type to extract and save elements
-                        for element_type in unique_element_types:
-                            elements = ifc_file.by_type(element_type)
-                            for element in elements:
+                        elements_to_extract = [
+                            element for element_type in unique_element_types for element in ifc_file.by_type(element_type)
+                            ]
+
+                        # Only components that are new or changed since the last upload of the project are exploded again
+                        component_bucket = storage_backend.bucket(bucket_name)
+                        previous_components = fingerprint.load_fingerprints(component_bucket, folder_name, fingerprint.COMPONENT_FINGERPRINT_PREFIX)
+                        index = ifchelper.get_relationship_index(ifc_file)
+                        hasher = fingerprint.RepresentationHasher()
+                        components = {
+                            element.GlobalId: {
+                                "fingerprint": fingerprint.get_element_fingerprint(element, get_object_data(ifc_file, element, index), hasher),
+                                "entities": [element.is_a()],
+                                "file": f"{folder_name}/{original_filename}_{element.GlobalId}.ifc",
+                            }
+                            for element in elements_to_extract
+                        }
+                        component_changes = fingerprint.diff_fingerprints(previous_components, components)
+                        unchanged_components = set(component_changes["unchanged"])
+                        elements_to_extract = [element for element in elements_to_extract if element.GlobalId not in unchanged_components]
+                        if previous_components:
+                            st.info(f"Components of {folder_name}: {fingerprint.format_changes(component_changes)}")
+                        progress_bar = st.progress(0.0)
+                        progress_text = st.empty()
+
+                        exploder = explode.ComponentExploder(ifc_file)
+
+                        # Extraction feeds a pool of upload threads, it only waits when too many files are queued
+                        with uploader.UploadPipeline(storage_backend, bucket_name, concurrency=upload_concurrency) as upload_pipeline:
+                            # Loop through each unique IfcElement type to extract and save elements
+                            for extracted_count, element in enumerate(elements_to_extract, start=1):
                                 guid = element.GlobalId
-                                extracted_file_path, extracted_file_name = extract_and_save_element(ifc_file, guid, save_dir, original_filename)
+                                extracted_file_path, extracted_file_name = exploder.write_component(guid, save_dir, original_filename)
 
                                 # Upload the extracted file to GCS
                                 destination_blob_name = f"{folder_name}/{extracted_file_name}"
-                                upload_blob(bucket_name, extracted_file_path, destination_blob_name)
-
-                        
-                        st.success(f"All elements have been extracted and saved to GCS bucket.")
+                                upload_pipeline.submit(extracted_file_path, destination_blob_name)
+
+                                progress = upload_pipeline.get_progress()
+                                progress_bar.progress(progress["uploaded"] / max(len(elements_to_extract), 1))
+                                progress_text.write(f"{extracted_count} of {len(elements_to_extract)} elements extracted, " + uploader.format_progress(progress))
+
+                            # Keep the readout moving while the last uploads finish
+                            while not upload_pipeline.wait(timeout=0.5):
+                                progress = upload_pipeline.get_progress()
+                                progress_bar.progress(progress["uploaded"] / max(len(elements_to_extract), 1))
+                                progress_text.write(uploader.format_progress(progress))
+
+                        progress = upload_pipeline.get_progress()
+                        progress_bar.progress(1.0)
+                        progress_text.write(uploader.format_progress(progress))
+
+                        # Components of removed elements are deleted, failed uploads are retried with the next revision
+                        for global_id in component_changes["removed"]:
+                            try:
+                                component_bucket.delete(previous_components[global_id]["file"])
+                            except storage.NotFound:
+                                pass
+                        failed_files = {blob_name for blob_name, _ in upload_pipeline.failures}
+                        components = {global_id: record for global_id, record in components.items() if record["file"] not in failed_files}
+                        fingerprint.save_fingerprints(
+                            component_bucket, folder_name, components, component_changes, fingerprint.COMPONENT_FINGERPRINT_PREFIX
+                            )
+                        if upload_pipeline.failures:
+                            st.error(f"{len(upload_pipeline.failures)} files could not be uploaded:")
+                            st.dataframe(pd.DataFrame(upload_pipeline.failures, columns=["File", "Error"]))
+                        else:
+                            st.success(f"All elements have been extracted and saved to GCS bucket.")
 
 
 
@@ -3,13 +3,15 @@
 import pandas as pd
 import ifcopenshell
 import numpy as np
+from tools import grid
 from tools import ifchelper
+from tools import normalize
 from tools import pandashelper
+from tools import spool
 from st_aggrid import GridOptionsBuilder, AgGrid, GridUpdateMode, DataReturnMode
 import streamlit as st
 import streamlit.components.v1 as components
 import altair as alt
-import base64
 from pandas.api.types import (
     is_categorical_dtype,
     is_datetime64_any_dtype,
@@ -23,8 +25,11 @@ session = st.session_state
 def callback_upload():
     st.session_state["file_name"] = st.session_state["uploaded_file"].name
     st.session_state["is_file_uploaded"] = True
-    st.session_state["array_buffer"] = st.session_state["uploaded_file"].getvalue()
-    st.session_state["ifc_file"] = ifcopenshell.file.from_string(st.session_state["uploaded_file"].getvalue().decode("utf-8"))
+    # Parsed from a spool file on disk once per file content, sessions uploading the same file share the model
+    # The session keeps the content hash, the model is fetched from the cache when it's used
+    st.session_state["model_hash"], st.session_state["ifc_path"] = spool.open_upload(
+        st.session_state["uploaded_file"], st.session_state.get("ifc_path")
+        )
 
 @st.cache
 def convert_df(df):
@@ -32,18 +37,22 @@ def convert_df(df):
     return df.to_csv().encode('utf-8')
 
 def get_ifc_pandas():
-    data = ifchelper.get_objects_data_by_class(
-        session.ifc_file,
-        "IfcBuildingElement"
-    )
-    df = ifchelper.create_pandas_dataframe(data)
+    # Extracted once per model, the shared DataFrame is copied before it is modified
+    df = spool.get_session_model(session).get_dataframe("IfcBuildingElement").copy()
     return df
 
+def get_normalized_dataframe(model):
+    # Volume, Mass, Embodied_CO2 and Connection_type from a column plan resolved once per column layout
+    return normalize.normalize_element_dataframe(model.get_dataframe("IfcElement").copy())
+
 def get_ifc_data():
-    file_data = ifchelper.get_objects_data_by_class(
-        session.ifc_file,
-        "IfcBuildingElement"
-    )
+    model = spool.get_session_model(session)
+    with model.lock:
+        file_data = ifchelper.get_objects_data_by_class(
+            model.ifc_file,
+            "IfcBuildingElement",
+            index=model.relationship_index
+        )
     return file_data
 
 def filter_dataframe(df: pd.DataFrame) -> pd.DataFrame:
@@ -135,16 +144,30 @@ def df_with_location_data():
     df_loc['lon'] = df_loc['lon'].astype(float)
     return df_loc
 
-def draw_configured_aggrid(df):
-    gb = GridOptionsBuilder.from_dataframe(df)
-    gb.configure_pagination(paginationAutoPageSize=True) #Add pagination
-    gb.configure_side_bar() #Add a sidebar
-    #gb.configure_selection(selection_mode="multiple", use_checkbox=True)
-    gb.configure_selection('multiple', use_checkbox=True, groupSelectsChildren="Group checkbox select children") #Enable multi-row selection, but it crashes 
-    gridOptions = gb.build()
+DEFAULT_GRID_COLUMNS = [
+    'Name', 'Class', 'PredefinedType', 'Level', 'Material', 'Connection_type', 'Volume', 'Mass', 'Embodied_CO2', 'Global ID'
+]
+GRID_PAGE_SIZE = 100
+
+def draw_configured_aggrid(df, non_empty_columns=None):
+    # Only the default columns and the page shown are sent to the grid, more columns can be added on request
+    if non_empty_columns is None:
+        non_empty_columns = grid.get_non_empty_columns(df)
+    default_columns = [column for column in DEFAULT_GRID_COLUMNS if column in df.columns]
+    extra_columns = st.multiselect(
+        "Add columns", [column for column in non_empty_columns if column not in default_columns]
+    )
+    col1, col2 = st.columns(2)
+    with col1:
+        page = st.number_input("Page", min_value=1, max_value=grid.get_page_count(df, GRID_PAGE_SIZE), value=1)
+    with col2:
+        st.write(f"{len(df)} components, {GRID_PAGE_SIZE} per page")
+    page_df = grid.get_page(df, page, GRID_PAGE_SIZE)[default_columns + extra_columns]
+    # Grid options are built once per column schema
+    gridOptions = grid.get_grid_options(page_df)
 
     grid_response = AgGrid(
-        df,
+        page_df,
         gridOptions=gridOptions,
         data_return_mode='AS_INPUT', 
         update_mode='MODEL_CHANGED', 
@@ -159,65 +182,17 @@ def draw_configured_aggrid(df):
     selected = grid_response['selected_rows'] 
     df = pd.DataFrame(selected) #Pass the selected rows to a new dataframe df
 
-def create_Dung_Beetle_columns(df):    
-    df.insert(9, "Volume", None, allow_duplicates=False)
-    df.insert(10, "Mass", None, allow_duplicates=False)
-    df.insert(11, "Embodied_CO2", None, allow_duplicates=False)    
-    return df
-
 def calculate_CO2_from_material_weight_and_AC_data(df):
     df['MaterialPsets.Embodied Carbon'] = df['MaterialPsets.Embodied Carbon'].fillna(0) 
     df['MaterialPsets.Embodied Carbon'] = df['MaterialPsets.Embodied Carbon'].str.rstrip(" (kgCO₂/kg)") 
     df['MaterialPsets.Embodied Carbon'] = df['MaterialPsets.Embodied Carbon'].astype(float)
     df["Carbon_from_material_calculations"] = df['MaterialPsets.Embodied Carbon'] * df['Mass']
 
-def consolidate_volume_data(df):
-    df_keys = list(df)
-    matchers = ['NetVolume', 'Volume (Net)', 'Volumen (netto)']
-    matching = [s for s in df_keys if any(xs in s for xs in matchers)]
-
-    print(matching)
-
-    for text in matching:
-        print(text)
-        df['Volume'] = df['Volume'].fillna(df[text])
-    return df
-
 def old_consolidate_volume_data(df):
     df['Volume'] = df['Volume'].fillna(df["QuantitySets.Qto_SlabBaseQuantities.NetVolume"])
     df['Volume'] = df['Volume'].fillna(df["QuantitySets.Component Quantities.Schicht/Komponenten Volumen (netto)"])
     return df
 
-def consolidate_mass_data(df):
-    df_keys = list(df)
-    matchers = ['Mass']
-    matching = [s for s in df_keys if any(xs in s for xs in matchers)]
-
-    print(matching)
-
-    for text in matching:
-        print(text)
-        df['Mass'] = df['Mass'].fillna(df[text])
-    return df
-
-def consolidate_carbon_data(df):
-    df_keys = list(df)
-    matchers1 = ['CO2']
-    matching1 = [s for s in df_keys if any(xs in s for xs in matchers1)]
-
-    matchers2 = ['Embodied Carbon']
-    matching2 = [s for s in df_keys if any(xs in s for xs in matchers2)]
-
-    for text in matching1:
-        print(text)
-        df['Embodied_CO2'] = df['Embodied_CO2'].fillna(df[text])
-
-    for text in matching2:
-        print(text)
-        df['Embodied_CO2'] = df['Embodied_CO2'].fillna(df[text])
-
-    return df
-
 def drop_containers(df):
     nc = df.drop(df[df["Global ID"].isin(df["Parent's GUID"])].index) 
     return nc
@@ -226,41 +201,26 @@ def drop_parts(df):
     np = df.drop(df[df["Parent's GUID"].isin(df["Global ID"])].index) 
     return np
 
-def cleanup_CO2_data(df):
-    df["Embodied_CO2"] = df["Embodied_CO2"].str.rstrip(" (kgCO₂)")  
-    df["Embodied_CO2"] = df["Embodied_CO2"].str.rstrip(" (kgCO₂/kg)")  
-    df["Embodied_CO2"] = df["Embodied_CO2"].fillna(0)
-    df["Embodied_CO2"] = df["Embodied_CO2"].astype(float)
-    return df
-
-def cleanup_mass_data(df):
-    df["Mass"] = df["Mass"].replace(r'^\s*$', np.nan, regex=True)
-    df["Mass"] = df["Mass"].fillna(0)
-    df["Mass"] = df["Mass"].astype(float)
-    return df
-
-def cleanup_material_data(df):
-    df["Material"] = df["Material"].astype(str)
-    df["Material"] = df["Material"].replace(r'^\s*$', np.nan, regex=True)
-    df["Material"] = df["Material"].fillna("Not defined")
-    return df
-
-def cleanup_profile_material_data(df):
-    if "PropertySets.ArchiCADProperties.Structure Type" in df.columns:
-        df.loc[df["PropertySets.ArchiCADProperties.Structure Type"] == "Complex Profile", "Material"] = df["PropertySets.ArchiCADProperties.Building Materials (All)"]
-    elif "PropertySets.ArchiCADProperties.Struktur-Typ" in df.columns:
-        df.loc[df["PropertySets.ArchiCADProperties.Struktur-Typ"] == "Profil", "Material"] = df["PropertySets.ArchiCADProperties.Baustoffe (Alle)"]
-    return df
-
-def consolidate_connection_data(df):
-    df["Connection_type"] = df["Connection_type"].fillna(df["MaterialPsets.Connection type"])
-    return df
-
-def rename_connection_type_column(df):
-    df.columns = df.columns.str.replace('PropertySets.D4D.10_Connection_type', 'Connection_type')
-    consolidate_connection_data(df)
-    df["Connection_type"] = df["Connection_type"].fillna("Not defined")
-    return df
+CHART_VALUES = ["Volume", "Mass", "Embodied_CO2"]
+DRILL_DOWN_COLUMNS = ['Name', 'Class', 'PredefinedType', 'Global ID', 'Material', 'Connection_type'] + CHART_VALUES
+
+def aggregate_chart_data(df):
+    # One row per Material and Connection_type, so the charts grow with the materials and not with the elements
+    chart_data = df.groupby(['Material', 'Connection_type'], observed=True, sort=False, dropna=False)[CHART_VALUES].sum()
+    chart_data['Elements'] = df.groupby(['Material', 'Connection_type'], observed=True, sort=False, dropna=False).size()
+    return chart_data.reset_index()
+
+def draw_chart_drill_down(df, chart_data):
+    # Element rows are only sent to the browser for the material picked here
+    materials = sorted(chart_data['Material'].dropna().unique(), key=str)
+    material = st.selectbox("Show the components of a material", ["-"] + materials)
+    if material != "-":
+        material_df = df[df['Material'] == material]
+        connection_types = sorted(material_df['Connection_type'].dropna().unique(), key=str)
+        connection_type = st.selectbox("Connection type", ["All"] + connection_types)
+        if connection_type != "All":
+            material_df = material_df[material_df['Connection_type'] == connection_type]
+        st.dataframe(material_df[[column for column in DRILL_DOWN_COLUMNS if column in material_df.columns]])
 
 def create_chart(df, yaxis):
     connection_to_color =  {
@@ -296,7 +256,7 @@ def create_chart(df, yaxis):
     chart_vol = alt.Chart(df).mark_bar().encode(
         x='Material',
         y=yaxis,
-        tooltip=['Material', 'Name', 'Class', 'PredefinedType', 'Global ID'],
+        tooltip=['Material', 'Connection_type', 'Elements', alt.Tooltip(yaxis, format=',.2f')],
         color=alt.Color('Connection_type', scale=domain_scale),
         shape=alt.Shape('Connection_type', scale=alt.Scale(domain=domain_scale.domain),
         
@@ -313,12 +273,9 @@ def execute():
     session["Dataframe"] = get_ifc_pandas()
     #df = get_ifc_pandas()
     
-    data = ifchelper.get_objects_data_by_class(
-        session.ifc_file,
-        "IfcElement"
-    )
-
-    df = ifchelper.create_pandas_dataframe(data)    
+    # Normalized once per model and shared, the frame isn't modified below
+    model = spool.get_session_model(session)
+    df = model.get_derived("Normalized IfcElement", get_normalized_dataframe)
 
     #st.dataframe(df)
 
@@ -328,18 +285,7 @@ def execute():
     
     #st.write("Check if DataFrame is being created:")
     #st.dataframe(df)
-    create_Dung_Beetle_columns(df)    
-    rename_connection_type_column(df)
-    
-    consolidate_volume_data(df)
-    consolidate_mass_data(df)
-    consolidate_carbon_data(df)
-    consolidate_connection_data(df)
     #st.dataframe(df)
-    cleanup_CO2_data(df)    
-    cleanup_material_data(df)
-    cleanup_profile_material_data(df)
-    cleanup_mass_data(df)
     #calculate_CO2_from_material_weight_and_AC_data(df)
     nc = drop_containers(df)
     np = drop_parts(df)
@@ -348,10 +294,11 @@ def execute():
     #st.header("All building components except container elements:")
     #draw_configured_aggrid(nc)
 
-    # Create charts
-    chart_vol = create_chart(nc, "Volume")
-    chart_mass = create_chart(nc, "Mass")
-    chart_CO2 = create_chart(nc, "Embodied_CO2")
+    # Create charts from the totals per Material and Connection_type
+    chart_data = aggregate_chart_data(nc)
+    chart_vol = create_chart(chart_data, "Volume")
+    chart_mass = create_chart(chart_data, "Mass")
+    chart_CO2 = create_chart(chart_data, "Embodied_CO2")
     #chart_vol = alt.Chart(np).mark_bar().encode(x="Material", y="Volume", color="Connection_type", tooltip=['Name', 'Class', 'PredefinedType', 'Global ID']).properties(height=700)
     #chart_mass = alt.Chart(nc).mark_bar().encode(x="Material", y="Mass", color="Connection_type").properties(height=700)
     #chart_CO2 = alt.Chart(nc).mark_bar().encode(x="Material", y="Embodied_CO2", color="Connection_type").properties(height=700)
@@ -365,29 +312,16 @@ def execute():
     st.altair_chart(chart_mass, use_container_width=True)
     st.header("Embodied CO₂ of construction materials (kgCO₂):")
     st.altair_chart(chart_CO2, use_container_width=True)   
+    draw_chart_drill_down(nc, chart_data)
 
     #st.write("Special thanks go to Dr. Kosek for healing the pain - respect!")
     #st.map(df) 
     
     st.header("All building components contained in your project:")
-    draw_configured_aggrid(df)  
+    non_empty_columns = model.get_derived("Non-empty columns of normalized IfcElement", lambda model: grid.get_non_empty_columns(df))
+    draw_configured_aggrid(df, non_empty_columns)  
 
 uploaded_file = st.sidebar.file_uploader("Choose a file", type="ifc", key="uploaded_file", on_change=callback_upload)
-if uploaded_file:
-    # Read the contents of the uploaded file
-    file_contents = uploaded_file.read()
-    # Encode the file contents as base64
-    base64_file_contents = base64.b64encode(file_contents).decode()
-    # Create a data URL
-    url = f"data:application/octet-stream;base64,{base64_file_contents}"
-    # Use data_url wherever you need it
-    # Example: passing it to another Streamlit component
-    # st.some_component(data_url)
-    # Create a hyperlink to download the file
-    url = f"data:application/octet-stream;base64,{base64_file_contents}"
-    st.session_state["IFC_href_ready"] = True
-    st.session_state["url"] = url
-    
 # don't get why is there the part after and below...
 if "is_file_uploaded" in st.session_state and st.session_state["is_file_uploaded"]:
     st.sidebar.success("File is loaded")
@@ -5,17 +5,19 @@ import ifcopenshell.util
 import ifcopenshell.api
 import ifcopenshell.util.placement
 import pandas as pd
-import pickle
 import streamlit as st
 import sys
 import tempfile
 import toml
 import os
 import urllib.parse
-from google.cloud import storage
 from google.oauth2.service_account import Credentials
 from pages.ifc_viewer.ifc_viewer import ifc_viewer
 from st_aggrid import GridOptionsBuilder, AgGrid, GridUpdateMode
+from tools import cache
+from tools import product_index
+from tools import storage
+from tools import warehouse_store
 
 # sys.path.append('./vendor')
 # from vendor import ifcpatch
@@ -78,29 +80,60 @@ if not credentials:
 
 # Now you can use `credentials` in your code
 
-# Create a Google Cloud Storage client
+# Storage backend shared with the other pages (GCS by default, DUNGBEETLE_STORAGE=local:<directory> without cloud access)
 # credentials = Credentials.from_service_account_info(st.secrets["GOOGLE_APPLICATION_CREDENTIALS"]) - this code worked in StremlitCloud
-storage_client = storage.Client(credentials=credentials)
+storage_backend = storage.get_storage(credentials)
 
 
 # @st.cache(suppress_st_warning=True, allow_output_mutation=True)
 @st.cache_data
 def download_file_from_gcs(bucket_name, blob_name, destination_file_name):
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    blob.download_to_filename(destination_file_name)
+    storage_backend.get_file(bucket_name, blob_name, destination_file_name)
 
 # @st.cache(suppress_st_warning=True, allow_output_mutation=True)
-@st.cache_data
+@st.cache_data(ttl=60)
 def get_gcs_bucket_files(bucket_name):
-    # Get the bucket from the Google Cloud Storage
-    bucket = storage_client.get_bucket(bucket_name)
-    
-    # Get the list of all blobs in the bucket
-    blobs = bucket.list_blobs()
+    bucket = storage_backend.bucket(bucket_name)
     
-    # Get the list of pickle file names
-    return [blob.name for blob in blobs if blob.name.endswith('.pickle')]
+    # Get the list of warehouse tables as "wh_" names
+    return [f"wh_{entity}" for entity in warehouse_store.list_warehouse_tables(bucket)]
+
+# Memory limit of the warehouse tables kept in memory, shared by all sessions
+WAREHOUSE_CACHE_BYTES = int(os.environ.get("DUNGBEETLE_WAREHOUSE_CACHE_MB", "512")) * 1024 * 1024
+
+@st.cache_resource
+def get_warehouse_table_cache():
+    return cache.LRUCache(WAREHOUSE_CACHE_BYTES)
+
+def get_warehouse_table_version(bucket_name, df_name):
+    return warehouse_store.get_table_version(storage_backend.bucket(bucket_name), df_name[len("wh_"):])
+
+def load_warehouse_table(bucket_name, df_name, columns, version):
+    # Tables are only read again when their manifest generation changed since they were cached
+    bucket = storage_backend.bucket(bucket_name)
+    entity = df_name[len("wh_"):]
+    return get_warehouse_table_cache().get_or_load(
+        (bucket_name, df_name, tuple(columns)),
+        version,
+        # Only the displayed columns are read from the table's Parquet segments
+        lambda: warehouse_store.read_warehouse_table(bucket, entity, columns=columns),
+        )
+
+def load_availability_index(bucket_name, df_name, df, version):
+    # Counts of identical products, built once per version of the table
+    return get_warehouse_table_cache().get_or_load(
+        (bucket_name, df_name, "availability"),
+        version,
+        lambda: product_index.GroupCountIndex(df, product_index.PRODUCT_MATCH_COLUMNS),
+        )
+
+def load_dimension_index(bucket_name, df_name, df, version):
+    # Grid-bucket index of the product dimensions, built once per version of the table
+    return get_warehouse_table_cache().get_or_load(
+        (bucket_name, df_name, "dimensions"),
+        version,
+        lambda: product_index.DimensionIndex(df, product_index.DIMENSION_COLUMNS),
+        )
 
 #@st.cache_data
 #def download_ifc_file_from_gcs_as_string(bucket_name, folder_name, guid):
@@ -123,16 +156,13 @@ def get_gcs_bucket_files(bucket_name):
 
 @st.cache_data
 def download_ifc_file_from_gcs_as_string(bucket_name, folder_name, guid):
-    bucket = storage_client.get_bucket(bucket_name)
-   
     blob_name = f"{folder_name}_{guid}.ifc"
     source_blob_name = f"{folder_name}/{blob_name}"
 
     local_path = os.path.join(tempfile.gettempdir(), blob_name)
 
     # Download the blob to the temporary local file
-    blob = bucket.blob(source_blob_name)
-    blob.download_to_filename(local_path)
+    storage_backend.get_file(bucket_name, source_blob_name, local_path)
  
     # Open the IFC file and convert to string
     ifc_file = ifcopenshell.open(local_path)
@@ -149,37 +179,32 @@ def download_ifc_file_from_gcs_as_string(bucket_name, folder_name, guid):
 
 def download_ifc_file_from_gcs(ifc_file_name):
     local_path = os.path.join(tempfile.gettempdir(), ifc_file_name)  # using tempfile for cross-platform compatibility
-    download_file_from_gcs('ifc_warehouse', ifc_file_name, local_path)
+    download_file_from_gcs(storage.IFC_WAREHOUSE_BUCKET, ifc_file_name, local_path)
     # Debugging code: st.write(local_path)
     return local_path
 
 def download_extracted_ifc_file_from_gcs(ifc_file_name):
     local_path = os.path.join(tempfile.gettempdir(), ifc_file_name)  # using tempfile for cross-platform compatibility
-    download_file_from_gcs_folder('ifc_warehouse', ifc_file_name, ifc_file_name, local_path)
+    download_file_from_gcs_folder(storage.IFC_WAREHOUSE_BUCKET, ifc_file_name, ifc_file_name, local_path)
     return local_path
 
 def download_file_from_gcs_folder(bucket_name, folder_name, file_name, destination_file_name):
-    bucket = storage_client.get_bucket(bucket_name)   
     # Combine folder_name and file_name to get the full blob_name
     blob_name = f"{folder_name}/{file_name}"   
-    blob = bucket.blob(blob_name)
-    blob.download_to_filename(destination_file_name)
-
-def upload_to_gcs(data, bucket_name, blob_name, credentials):
-    storage_client = storage.Client(credentials=credentials)
-    bucket = storage_client.bucket(bucket_name)
-    # List all blobs and convert the iterator to a list
-    blobs = list(bucket.list_blobs())    
+    storage_backend.get_file(bucket_name, blob_name, destination_file_name)
+
+def upload_to_gcs(data, bucket_name, blob_name):
+    bucket = storage_backend.bucket(bucket_name)
     # Delete all existing blobs in the bucket
-    if len(blobs) > 0:
-        bucket.delete_blobs(blobs)
-    blob = bucket.blob(blob_name)
-    blob.upload_from_string(data)
+    for info in list(bucket.list()):
+        bucket.delete(info.name)
+    bucket.put(blob_name, data)
     # Make the blob publicly readable
-    blob.make_public()
-    return blob.public_url
+    return bucket.public_url(blob_name)
 
 dataframes = {}
+availability_indexes = {}
+dimension_indexes = {}
 
 column_map = {
     'PredefinedType': 'Product Type',
@@ -213,32 +238,33 @@ tab_map = {
     'wh_IfcWindow': 'Windows'
 }
 
-pickle_bucket_name = 'pickle_warehouse'
-pickle_files = get_gcs_bucket_files(pickle_bucket_name)
+warehouse_bucket_name = storage.WAREHOUSE_BUCKET
+table_names = get_gcs_bucket_files(warehouse_bucket_name)
 
-for pickle_file in pickle_files:
-    local_path = tempfile.gettempdir() + '/' + pickle_file  # using tempfile for cross-platform compatibility
-    download_file_from_gcs(pickle_bucket_name, pickle_file, local_path)
-    with open(local_path, 'rb') as f:
-        df = pickle.load(f)
+# Make sure only the tabs that have a corresponding table are displayed
+tab_names = [tab_map.get(df_name, df_name) for df_name in table_names if df_name in tab_map]
 
-    # Keep only the columns present in both the dataframe and the column_map
-    columns_to_keep = list(set(df.columns) & set(column_map.keys()))
+selected_tab = st.sidebar.selectbox("Select a product group", tab_names)
+
+# Only the table of the selected tab is downloaded and read
+for df_name in table_names:
+    if tab_map.get(df_name, df_name) != selected_tab:
+        continue
+    version = get_warehouse_table_version(warehouse_bucket_name, df_name)
+    df = load_warehouse_table(warehouse_bucket_name, df_name, list(column_map.keys()), version)
 
     # Rearrange the columns according to the order in column_map
-    ordered_columns = [col for col in column_map.keys() if col in columns_to_keep]
+    ordered_columns = [col for col in column_map.keys() if col in df.columns]
     df = df.loc[:, ordered_columns]
 
     df.rename(columns=column_map, inplace=True)
-    df_name = pickle_file[:-7]
+    availability_index = load_availability_index(warehouse_bucket_name, df_name, df, version)
+    dimension_indexes[df_name] = load_dimension_index(warehouse_bucket_name, df_name, df, version)
+    # "N available" in every row of the grid
+    df.insert(0, "Available", availability_index.row_counts)
+    availability_indexes[df_name] = availability_index
     dataframes[df_name] = df
 
-
-# Make sure only the tabs that have a corresponding dataframe are displayed
-tab_names = [tab_map.get(df_name, df_name) for df_name in dataframes.keys() if df_name in tab_map]
-
-selected_tab = st.sidebar.selectbox("Select a product group", tab_names)
-
 # def download_product_by_guid(input_file_name, guid):
 #     # Download and open an IFC source file
 #     src_ifc_file = ifcopenshell.open(download_ifc_file_from_gcs(f"{input_file_name}.ifc"))
@@ -331,52 +357,52 @@ def search_google_for_selected_row(sel_row_list):
         unsafe_allow_html=True
     )
 
-def check_available_quantity_of_products(df, sel_row, *columns):
+def check_available_quantity_of_products(availability_index, sel_row):
     """
-    Count the number of rows in df that match the selected row based on specified columns.
+    Count the number of products that match the selected row on Manufacturer, Model, Article number and dimensions.
 
     Parameters:
-    - df: DataFrame containing the products
+    - availability_index: product_index.GroupCountIndex of the table
     - sel_row: List of dictionaries containing a single selected row from the AgGrid
-    - columns: column names to match against
 
     Returns:
-    - int: number of matching rows in df
+    - int: number of matching rows in the table
     """
 
     if not sel_row:
         return 0
 
-    sel_row_dict = sel_row[0]  # Get the first (and presumably only) dictionary in the list
-
-    # Only consider columns that actually exist in both the DataFrame and the selected row dictionary
-    existing_columns = [col for col in columns if col in df.columns and col in sel_row_dict]
-
-    # Create a DataFrame that will be used to store the filtered conditions
-    filtered_df = pd.DataFrame(index=df.index)
-
-    for col in existing_columns:
-        value = sel_row_dict.get(col, None)
-        if value is not None:
-            filtered_df[col] = df[col] == value
-        else:
-            # If the value in sel_row_dict is None, then only consider rows in df where the column is also None
-            filtered_df[col] = df[col].isna()
-
-    # Combine conditions across multiple columns using the 'all' function along axis=1
-    final_condition = filtered_df.all(axis=1)
-
-    return len(df[final_condition])
+    # Lookup in the counts computed when the table was loaded
+    return availability_index.count(sel_row[0])
+
+def get_dimension_search():
+    """Dimensions (0 if not relevant) and tolerance in cm entered in the sidebar, None if no dimension was entered"""
+    with st.sidebar.expander("Search by dimensions"):
+        st.write("Enter the dimensions you need in any order, leave 0 for dimensions that don't matter")
+        dimensions = [
+            st.number_input(label, min_value=0.0, value=0.0, step=1.0, key=f"dimension_search_{label}")
+            for label in ["Dimension 1 [cm]", "Dimension 2 [cm]", "Dimension 3 [cm]"]
+        ]
+        tolerance = st.number_input("Tolerance ± [cm]", min_value=0.0, value=2.0, step=0.5)
+    if not any(dimensions):
+        return None
+    return dimensions, tolerance
 
 def create_user_interface():
+    dimension_search = get_dimension_search()
     for df_name, df in dataframes.items():
         if tab_map.get(df_name, df_name) == selected_tab:
             st.write('Filter the database below to find suitable product and to download the IFC digital product representation')
+            if dimension_search:
+                # Products within the tolerance, nearest first
+                dimensions, tolerance = dimension_search
+                df = dimension_indexes[df_name].search_dataframe(df, dimensions, tolerance)
+                st.write(f"{len(df)} products within ± {tolerance:g} cm of {' x '.join(f'{dimension:g}' for dimension in dimensions if dimension)} cm")
             with st.container():
                 grid_table, sel_row = AgGrid_with_display_rules(df)
                 sel_row_for_map = pd.DataFrame(sel_row)
                 # DEBUG: st.write(sel_row)
-                quantity_of_products = check_available_quantity_of_products(df, sel_row, "Manufacturer", "Model", "Article number", "Length_[cm]", "Width_[cm]", "Height_[cm]")
+                quantity_of_products = check_available_quantity_of_products(availability_indexes[df_name], sel_row)
 
             # st.write("See map below for location of our building products, choose product group from the sidebar")
             # Initialize the columns
@@ -429,10 +455,10 @@ def create_user_interface():
                     unsafe_allow_html=True
                 ):
                     if input_file_name and input_guid:
-                        new_ifc_file_str, new_ifc_file_name = download_ifc_file_from_gcs_as_string('ifc_warehouse', input_file_name, input_guid)
+                        new_ifc_file_str, new_ifc_file_name = download_ifc_file_from_gcs_as_string(storage.IFC_WAREHOUSE_BUCKET, input_file_name, input_guid)
                         
                         # Upload the IFC data to Google Cloud Storage
-                        url_to_ifc_file = upload_to_gcs(new_ifc_file_str, 'streamlit_warehouse', new_ifc_file_name, credentials)
+                        url_to_ifc_file = upload_to_gcs(new_ifc_file_str, storage.VIEWER_BUCKET, new_ifc_file_name)
                         url = url_to_ifc_file
                 
             # Call the IFC viewer function
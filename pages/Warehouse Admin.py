@@ -1,6 +1,7 @@
 import numpy as np
 import ifcopenshell
 import io
+import json
 import pandas as pd
 import streamlit as st
 import tempfile
@@ -8,12 +9,14 @@ import toml
 import os
 from datetime import datetime
 from io import BytesIO
-from geopy.extra.rate_limiter import RateLimiter
-from geopy.geocoders import Nominatim
-from google.cloud import storage
 from google.oauth2.service_account import Credentials
 from tools import BoundingBox 
+from tools import fingerprint
+from tools import geocoding
 from tools import ifchelper
+from tools import ingest
+from tools import storage
+from tools import warehouse_store
 
 # ========== Page title and welcome message, page config ==========
 
@@ -74,40 +77,33 @@ if not credentials:
 
 # Now you can use `credentials` in your code
 
-# ========== Create a Google Cloud Storage client ==========
+# ========== Storage backend ==========
 
 # credentials = Credentials.from_service_account_info(st.secrets["GOOGLE_APPLICATION_CREDENTIALS"]) -> This code worked with StreamlitCloud
-storage_client = storage.Client(credentials=credentials)
+# GCS by default, DUNGBEETLE_STORAGE=local:<directory> runs the page without cloud access
+storage_backend = storage.get_storage(credentials)
 
 
 # ========== Function definitions ==========
 
 def save_to_bucket(uploaded_file, blob_name):
-    """Save a file to a GCS bucket."""
-    bucket = storage_client.bucket('warehouse_processing_directory')
-    blob = bucket.blob(blob_name)
-    blob.upload_from_file(uploaded_file)
+    """Save a file to the IFC processing bucket."""
+    storage_backend.put(storage.IFC_PROCESSING_BUCKET, blob_name, uploaded_file)
 
 def delete_from_bucket(blob_name):
-    """Delete a file from a GCS bucket."""
-    bucket = storage_client.bucket('warehouse_processing_directory')
-    blob = bucket.blob(blob_name)    
-    blob.delete()
+    """Delete a file from the IFC processing bucket."""
+    storage_backend.delete(storage.IFC_PROCESSING_BUCKET, blob_name)
 
-def delete_pickles(bucket_name):
-    blobs = storage_client.list_blobs(bucket_name)
-    for blob in blobs:
-        if blob.name.endswith('.pickle'):
-            blob.delete()
+def delete_tables(bucket_name):
+    for info in storage_backend.list(bucket_name):
+        if info.name.endswith(('.pickle', warehouse_store.TABLE_SUFFIX)) or info.name.startswith(REVISION_PREFIX):
+            storage_backend.delete(bucket_name, info.name)
 
 def download_from_bucket(blob_name):
-    """Download a file from a GCS bucket."""
-    bucket = storage_client.bucket('warehouse_processing_directory')
-    blob = bucket.blob(blob_name)
-    _, temp_local_filename = tempfile.mkstemp()
-    with open(temp_local_filename, 'wb') as f:
-        storage_client.download_blob_to_file(blob, f)
-    return temp_local_filename
+    """Download a file from the IFC processing bucket."""
+    temp_file, temp_local_filename = tempfile.mkstemp()
+    os.close(temp_file)
+    return storage_backend.get_file(storage.IFC_PROCESSING_BUCKET, blob_name, temp_local_filename)
 
 
 # def get_project_geocoordinates(generated_df):
@@ -128,14 +124,8 @@ def download_from_bucket(blob_name):
 #     generated_df['altitude'] = generated_df['altitude'].astype('float64')
 #     generated_df.drop(columns=['location', 'point', 'altitude'], inplace=True)
 
-def get_project_geocoordinates(generated_df):
-    locator = Nominatim(user_agent="OpenMapQuest")
-    geocode = RateLimiter(locator.geocode, min_delay_seconds=1)
-    
+def get_project_geocoordinates(generated_df, point):
     if not generated_df.empty:
-        location = geocode(generated_df.iloc[0]['Complete address'])
-        point = tuple(location.point) if location else (np.nan, np.nan, np.nan)
-        
         # Add latitude, longitude, and altitude to the entire dataframe
         generated_df['latitude'] = point[0]
         generated_df['longitude'] = point[1]
@@ -165,90 +155,124 @@ def get_project_address(ifc_file_admin_upload):
     return building_ID, street, post_code, town, canton, country, complete_address
 
 def move_file_between_buckets(source_bucket_name, destination_bucket_name, blob_name):
-    """Moves a file from one GCS bucket to another."""
-    source_bucket = storage_client.bucket(source_bucket_name)
-    destination_bucket = storage_client.bucket(destination_bucket_name)
-    blob = source_bucket.blob(blob_name)
-    
-    # Create new blob
-    new_blob = destination_bucket.blob(blob.name)
-    
-    # Rewrite the source blob to the destination blob
-    token = None
-    while True:
-        token, _, _ = new_blob.rewrite(blob, token=token)
-        if token is None:
-            break
-
-    # Delete the original blob
-    blob.delete()
-
-def save_pickle_to_bucket(pickle_data, blob_name):
-    """Save a pickle file to a GCS bucket."""
-    bucket = storage_client.bucket('pickles_processing_directory')
-    blob = bucket.blob(blob_name)
-    blob.upload_from_file(pickle_data)
-
-def backup_pickles():
-    """Backup all pickle files from 'pickle_warehouse' to 'pickles_backup' with current day and hour in the name"""
-    # Define the buckets
-    source_bucket = storage_client.bucket('pickle_warehouse')
-    destination_bucket = storage_client.bucket('pickles_backup')
-    
-    # Get the current day and hour
-    now = datetime.now()
-    day_hour = now.strftime("%Y%m%d_%H%M")
-    
-    # Get all blobs in the source bucket
-    blobs = source_bucket.list_blobs()
-
-    for blob in blobs:
-        if blob.name.endswith('.pickle'):
-            # Create a new blob name
-            new_blob_name = f"{blob.name[:-7]}_{day_hour}.pickle"
-            
-            # Create new blob
-            new_blob = destination_bucket.blob(new_blob_name)
-            
-            # Copy the blob to the new blob
-            new_blob.rewrite(blob)
+    """Moves a file from one bucket to another."""
+    storage_backend.move(source_bucket_name, blob_name, destination_bucket_name)
+
+def save_table_to_bucket(table_data, blob_name):
+    """Save a Parquet table to the table processing bucket."""
+    storage_backend.put(storage.TABLE_PROCESSING_BUCKET, blob_name, table_data, content_type="application/octet-stream")
+
+REVISION_PREFIX = "revision_"
+
+def warehouse_has_project(project_id, entities):
+    """Whether any of the warehouse tables of entities has rows of the project"""
+    warehouse_bucket = storage_backend.bucket(storage.WAREHOUSE_BUCKET)
+    existing_entities = set(warehouse_store.list_warehouse_tables(warehouse_bucket))
+    for entity in entities:
+        if entity in existing_entities:
+            project_rows = warehouse_store.read_warehouse_table(
+                warehouse_bucket, entity, columns=["Project ID"], filters=[("Project ID", "==", project_id)]
+                )
+            if len(project_rows):
+                return True
+    return False
+
+def save_revision(project_id, previous_fingerprints, fingerprints, dropped_ids=()):
+    """
+    Save what merging this revision of the project changes: the fingerprints of its elements and, per entity,
+    the Global IDs whose warehouse rows are replaced (changed elements) or removed (elements no longer in the file).
+    Elements in dropped_ids have no rows to merge (e.g. no coordinates): their warehouse rows are kept and they
+    keep their previous fingerprint, so the next revision extracts them again.
+    """
+    changes = fingerprint.diff_fingerprints(previous_fingerprints, fingerprints)
+    fingerprints = {
+        global_id: previous_fingerprints[global_id] if global_id in dropped_ids else record
+        for global_id, record in fingerprints.items()
+        if global_id not in dropped_ids or global_id in previous_fingerprints
+    }
+    replaced = [global_id for global_id in changes["changed"] if global_id not in dropped_ids] + changes["removed"]
+    if not previous_fingerprints:
+        # Projects merged before fingerprints were stored are replaced as a whole, new projects have nothing to replace
+        added = [global_id for global_id in changes["added"] if global_id not in dropped_ids]
+        added_entities = {entity for global_id in added for entity in fingerprints[global_id]["entities"]}
+        if warehouse_has_project(project_id, added_entities):
+            replaced += added
+    replaced_by_entity = {}
+    for global_id in replaced:
+        records = [fingerprints.get(global_id), previous_fingerprints.get(global_id)]
+        for entity in {entity for record in records if record for entity in record["entities"]}:
+            replaced_by_entity.setdefault(entity, []).append(global_id)
+    revision = {"project_id": project_id, "fingerprints": fingerprints, "changes": changes, "replaced": replaced_by_entity}
+    storage_backend.put(storage.TABLE_PROCESSING_BUCKET, f"{REVISION_PREFIX}{project_id}.json", json.dumps(revision), content_type="application/json")
+    return changes
+
+def snapshot_warehouse(label=""):
+    """Snapshot all warehouse tables. Only manifests are written, no table data is copied"""
+    warehouse_bucket = storage_backend.bucket(storage.WAREHOUSE_BUCKET)
+    convert_pickle_warehouse(warehouse_bucket)
+    # The stored fingerprints describe the tables' rows and are snapshotted with them
+    return warehouse_store.create_snapshot(warehouse_bucket, label, blob_prefixes=[fingerprint.FINGERPRINT_PREFIX])
+
+def restore_warehouse_snapshot(snapshot_name):
+    """Bring all warehouse tables back to the state of a snapshot"""
+    warehouse_bucket = storage_backend.bucket(storage.WAREHOUSE_BUCKET)
+    # Keep the current state restorable as well
+    snapshot_warehouse(f"Before restoring {snapshot_name}")
+    warehouse_store.restore_snapshot(warehouse_bucket, snapshot_name, blob_prefixes=[fingerprint.FINGERPRINT_PREFIX])
+
+def convert_pickle_warehouse(warehouse_bucket):
+    """Convert 'wh_' pickles written before the Parquet format into Parquet tables"""
+    for info in list(warehouse_bucket.list(prefix="wh_")):
+        if info.name.endswith(".pickle"):
+            wh_df = pd.read_pickle(BytesIO(warehouse_bucket.get(info.name)))
+            wh_table_name = info.name[:-len(".pickle")] + warehouse_store.TABLE_SUFFIX
+            warehouse_bucket.put(wh_table_name, warehouse_store.write_table(wh_df), content_type="application/octet-stream")
+            warehouse_bucket.delete(info.name)
 
 def merge_dataframes():
-    """Merge pickled dataframes from 'pickles_processing_directory' to 'pickle_warehouse'"""
+    """Append the Parquet tables from the table processing bucket to the warehouse as new segments"""
     # Define the buckets
-    processing_bucket = storage_client.bucket('pickles_processing_directory')
-    warehouse_bucket = storage_client.bucket('pickle_warehouse')
+    processing_bucket = storage_backend.bucket(storage.TABLE_PROCESSING_BUCKET)
+    warehouse_bucket = storage_backend.bucket(storage.WAREHOUSE_BUCKET)
+
+    convert_pickle_warehouse(warehouse_bucket)
+
+    # Rows of changed and removed elements of the merged revisions, as (Project ID, Global ID) per entity
+    revisions = [json.loads(processing_bucket.get(info.name)) for info in list(processing_bucket.list(prefix=REVISION_PREFIX))]
+    tombstones = {}
+    for revision in revisions:
+        for entity, global_ids in revision["replaced"].items():
+            tombstones.setdefault(entity, []).extend((revision["project_id"], global_id) for global_id in global_ids)
 
-    # Get all blobs in the processing bucket
-    processing_blobs = processing_bucket.list_blobs()
+    # Get all temp tables in the processing bucket
+    processing_blobs = list(processing_bucket.list(prefix="temp_"))
     
     for temp_blob in processing_blobs:
-        if temp_blob.name.startswith("temp_") and temp_blob.name.endswith(".pickle"):
+        if temp_blob.name.endswith(warehouse_store.TABLE_SUFFIX):
             # Load the temp dataframe
-            temp_df = pd.read_pickle(BytesIO(temp_blob.download_as_bytes()))
+            temp_df = warehouse_store.read_table(processing_bucket.get(temp_blob.name))
 
             # Get the entity name
-            entity = temp_blob.name[5:-7]  # Removing "temp_" and ".pickle"
-
-            # Check if there is a "wh_" blob in the warehouse bucket
-            wh_blob = warehouse_bucket.blob(f"wh_{entity}.pickle")
-            
-            if wh_blob.exists():
-                # If exists, load the warehouse dataframe and merge with the temp dataframe
-                wh_df = pd.read_pickle(BytesIO(wh_blob.download_as_bytes()))
-                merged_df = pd.concat([wh_df, temp_df])
-                
-                # Save the merged dataframe back to the "wh_" blob
-                buffer = BytesIO()
-                merged_df.to_pickle(buffer)
-                wh_blob.upload_from_string(buffer.getvalue())
-            else:
-                # If not exists, rename the temp blob to "wh_" and move to the warehouse bucket
-                new_blob = warehouse_bucket.blob(f"wh_{entity}.pickle")
-                new_blob.rewrite(temp_blob)
+            entity = temp_blob.name[len("temp_"):-len(warehouse_store.TABLE_SUFFIX)]
+
+            # Only the new and changed rows are written, the existing "wh_" segments are left untouched
+            entity_tombstones = tombstones.pop(entity, None)
+            if len(temp_df) or entity_tombstones:
+                warehouse_store.append_segment(warehouse_bucket, entity, temp_df, tombstones=entity_tombstones)
+                # Fold the segments together once there are too many of them
+                warehouse_store.start_background_compaction(warehouse_bucket, entity)
 
             # Delete the temp blob after processing
-            temp_blob.delete()
+            processing_bucket.delete(temp_blob.name)
+
+    # Removed elements of entities without a temp table
+    for entity, entity_tombstones in tombstones.items():
+        warehouse_store.append_segment(warehouse_bucket, entity, None, tombstones=entity_tombstones)
+
+    # The merged revisions are the base the next revisions of the projects are compared with
+    for revision in revisions:
+        fingerprint.save_fingerprints(warehouse_bucket, revision["project_id"], revision["fingerprints"], revision["changes"])
+        processing_bucket.delete(f"{REVISION_PREFIX}{revision['project_id']}.json")
 
 # ========== Get IfcBoundingBox dimensions ==========
 
@@ -383,48 +407,67 @@ def main_app():
             display_ifc_project_units(conversion_factor, length_unit)
             # Get the project address
             building_ID, street, post_code, town, canton, country, complete_address = get_project_address(ifc_file_admin_upload)
+            # Locate the project once per upload: IfcSite georeferencing first, then the (cached) geocoder
+            project_point = geocoding.get_project_point(ifc_file_admin_upload, complete_address)
+            geocode_statistics = geocoding.get_geocode_cache().get_statistics()
+            st.caption(f"Geocoding cache: {geocode_statistics['hits']} hits, {geocode_statistics['misses']} misses")
+            # Extract object data and dimensions of all IfcEntities in a single pass over the file,
+            # only for the elements that are new or changed since the last merged revision of the project
+            project_id = uploaded_file.name[:-4]
+            previous_fingerprints = fingerprint.load_fingerprints(storage_backend.bucket(storage.WAREHOUSE_BUCKET), project_id)
+            entity_dataframes, entity_dimension_rows, fingerprints = ingest.ingest_revision(
+                ifc_file_admin_upload, IfcEntities, previous_fingerprints
+                )
+            dropped_ids = set()
             # Loop through the IfcEntities and append data to the respective dataframe
             for entity in IfcEntities:
-                warehouse_data = ifchelper.get_objects_data_by_class(ifc_file_admin_upload, entity)
-                # DEBUG: st.write(warehouse_data)
-                # DEBUG: st.text(type(warehouse_data))
-                generated_df = ifchelper.create_pandas_dataframe(warehouse_data)
-                dimensions_df = BoundingBox.get_bounding_box_dimensions(ifc_file_admin_upload, entity, conversion_factor)
+                generated_df = entity_dataframes[entity]
+                # Entities without (changed) elements have an empty DataFrame without columns
+                if generated_df.empty or 'Global ID' not in generated_df.columns:
+                    continue
+                dimensions_df = BoundingBox.create_dimensions_dataframe(entity_dimension_rows[entity], conversion_factor)
                 # DEBUG: st.write(generated_df)
                 # DEBUG: st.write(dimensions_df) # DEBUG
                 generated_df = merge_dimensions_with_generated_df(dimensions_df, generated_df)
                 # DEBUG: st.write(generated_df) # DEBUG
                 generated_df['Building ID'] = building_ID
-                generated_df['Project ID'] = uploaded_file.name[:-4]
+                generated_df['Project ID'] = project_id
                 generated_df['Street'] = street
                 generated_df['Post code'] = post_code
                 generated_df['Town'] = town
                 generated_df['Canton'] = canton
                 generated_df['Country'] = country
                 generated_df['Complete address'] = complete_address
-                get_project_geocoordinates(generated_df)
+                get_project_geocoordinates(generated_df, project_point)
                 # Remove rows with missing latitude or longitude values
                 # DEBUG: st.write("Test obtaining geocoordinates")
                 # DEBUG: st.write(generated_df)
-                generated_df = generated_df.dropna(subset=['latitude', 'longitude'])
+                located = generated_df[['latitude', 'longitude']].notna().all(axis=1)
+                dropped_ids.update(generated_df.loc[~located, 'Global ID'])
+                generated_df = generated_df[located]
                 # DEBUG: st.write("Test removing rowd with missing latitiude and longitude")
                 # DEBUG: st.write(generated_df)
                 ifcEntity_dataframes["temp_" + entity] = pd.concat([ifcEntity_dataframes["temp_" + entity], generated_df], ignore_index=True)
+
+            # Only the fingerprints of elements whose rows are merged are stored
+            changes = save_revision(project_id, previous_fingerprints, fingerprints, dropped_ids)
+            if previous_fingerprints:
+                st.info(f"Revision of {project_id}: {fingerprint.format_changes(changes)} elements")
+            if dropped_ids:
+                st.warning(f"{len(dropped_ids)} elements have no coordinates and will not be merged, they are extracted again with the next upload")
                         
             # Print the dataframes and provide download button
             for entity, generated_df in ifcEntity_dataframes.items():
                 st.write(f"{entity}:")
                 st.write(generated_df)
                 st.map(generated_df)
-                pickle_data = io.BytesIO()
-                generated_df.to_pickle(pickle_data)
-                pickle_data.seek(0)
-                # Save the generated pickle to the bucket
-                save_pickle_to_bucket(pickle_data, f"{entity}.pickle")
+                table_data = warehouse_store.write_table(generated_df)
+                # Save the generated table to the bucket
+                save_table_to_bucket(table_data, f"{entity}{warehouse_store.TABLE_SUFFIX}")
                 st.download_button(
-                    label=f"Download {entity}.pickle",
-                    data=pickle_data,
-                    file_name=f"{entity}.pickle",
+                    label=f"Download {entity}{warehouse_store.TABLE_SUFFIX}",
+                    data=table_data,
+                    file_name=f"{entity}{warehouse_store.TABLE_SUFFIX}",
                     mime="application/octet-stream",
                 )
 
@@ -436,9 +479,9 @@ def main_app():
             col1, col2 = st.columns(2)  # Create two columns
             with col1:
                 if st.button("REJECT"):
-                    # Delete the IFC file and the pickle files from 'warehouse_processing_directory' bucket
+                    # Delete the IFC file and the table files from 'warehouse_processing_directory' bucket
                     delete_from_bucket(blob_name)
-                    delete_pickles("pickles_processing_directory")
+                    delete_tables(storage.TABLE_PROCESSING_BUCKET)
                     st.success("SUCCESS!")
                     st.session_state["file_uploader_key"] += 1
                     st.session_state["uploaded_ifc_file"] = "You have rejected the merge with the main GCS DataFrame, please reload this page to restart the process."
@@ -449,25 +492,39 @@ def main_app():
             with col2:
                 if st.button("APPROVE"):
                     st.session_state["rerun_page"] = "no"
-                    # Upload the IFC file to 'ifc_warehouse' bucket and pickles to 'pickles_processing_directory'
-                    move_file_between_buckets('warehouse_processing_directory', 'ifc_warehouse', blob_name)
+                    # Upload the IFC file to 'ifc_warehouse' bucket and tables to 'pickles_processing_directory'
+                    move_file_between_buckets(storage.IFC_PROCESSING_BUCKET, storage.IFC_WAREHOUSE_BUCKET, blob_name)
                     for entity, generated_df in ifcEntity_dataframes.items():
-                        pickle_data = io.BytesIO()
-                        generated_df.to_pickle(pickle_data)
-                        pickle_data.seek(0)
-                        save_pickle_to_bucket(pickle_data, f"{entity}.pickle")
-                        backup_pickles()
-                        merge_dataframes()
-                        st.success("SUCCESS!")
-                        st.session_state["file_uploader_key"] += 1
-                        st.session_state["uploaded_ifc_file"] = "Your file has successfully been uploaded to GCS main DataFrame"
-                        # st.session_state["rerun_page"] = "no"
-                        st.experimental_rerun()
+                        save_table_to_bucket(warehouse_store.write_table(generated_df), f"{entity}{warehouse_store.TABLE_SUFFIX}")
+                    # One snapshot of the warehouse before merging the whole upload
+                    snapshot_warehouse(f"Before merging {blob_name}")
+                    merge_dataframes()
+                    st.success("SUCCESS!")
+                    st.session_state["file_uploader_key"] += 1
+                    st.session_state["uploaded_ifc_file"] = "Your file has successfully been uploaded to GCS main DataFrame"
+                    # st.session_state["rerun_page"] = "no"
+                    st.experimental_rerun()
                 st.write("If you have checked the content of the dataframes and are confident that the data meets Dung Beetle requirements click APPROVE. Your data will be merged with the main database.")
 
     if "rerun_page" in st.session_state and st.session_state["rerun_page"] == "no":
         st.write("", st.session_state["uploaded_ifc_file"])
 
+    # ========== Warehouse snapshots ==========
+
+    with st.expander("Warehouse snapshots"):
+        snapshots = warehouse_store.list_snapshots(storage_backend.bucket(storage.WAREHOUSE_BUCKET))
+        if not snapshots:
+            st.write("No snapshots yet, one is taken before every approved upload.")
+        else:
+            st.dataframe(pd.DataFrame([
+                {"Snapshot": snapshot["name"], "Created": snapshot["created"], "Label": snapshot["label"], **snapshot["tables"]}
+                for snapshot in snapshots
+            ]))
+            snapshot_name = st.selectbox("Snapshot to restore", [snapshot["name"] for snapshot in snapshots])
+            if st.button("RESTORE"):
+                restore_warehouse_snapshot(snapshot_name)
+                st.success(f"The warehouse has been restored to {snapshot_name}")
+
 # ========== Protect content with password ==========
 
 # Custom session state
@@ -17,10 +17,13 @@
 # See a copy of the GNU Lesser General Public License here:
 # <http://www.gnu.org/licenses/>.
 
+import multiprocessing
+import numpy as np
 import pandas as pd
 import streamlit as st
 import ifcopenshell
 import ifcopenshell.geom
+import ifcopenshell.util.placement
 from ifcopenshell.util.shape import get_x, get_y, get_z, get_bbox, get_vertices
 
 
@@ -88,52 +91,154 @@ def get_bbox_local(file, entity, conversion_factor): #PROTOTYPE
 
 
 def get_bounding_box_dimensions(file, entity, conversion_factor):
+    elements = [
+        element for element in file.by_type(entity)
+        if hasattr(element, "Representation") and element.Representation is not None
+    ]
+    extents = get_element_extents(file, elements)
     data = []
-    settings = ifcopenshell.geom.settings()
-    
-    elements = file.by_type(entity)
     for element in elements:
-        found = False
         name = element.Name if element.Name else "N/A"
         global_id = element.GlobalId if element.GlobalId else "N/A"
-        x, y, z = None, None, None  # Default values
-
-        if hasattr(element, "Representation") and element.Representation is not None:
-            for rep in element.Representation.Representations:
-                if rep.is_a("IfcShapeRepresentation"):
-                    for item in rep.Items:
-                        if item.is_a("IfcBoundingBox"):
-                            x = item.XDim
-                            y = item.YDim
-                            z = item.ZDim
-                            found = True
-                            break
-                    if found:
-                        break
+        x, y, z = extents.get(element.GlobalId, (None, None, None))
+        data.append([name, global_id, x, y, z])
+    return create_dimensions_dataframe(data, conversion_factor)
 
-            if not found:
-                representation = element.Representation.Representations[0] if element.Representation else None
-                try:
-                    if representation:
-                        geometry = ifcopenshell.geom.create_shape(settings, representation)
-                        x = get_x(geometry)
-                        y = get_y(geometry)
-                        z = get_z(geometry)
-                    else:
-                        x, y, z = None, None, None
-                except RuntimeError:
-                    print(f"Failed to process representation for element {element.GlobalId}. Skipping.")
-                    x, y, z = None, None, None  # set to None if failed
 
-            data.append([name, global_id, x, y, z])  # Only append here, inside the loop
-            
+def create_dimensions_dataframe(data, conversion_factor):
     df = pd.DataFrame(data, columns=["Name", "Global ID", "Length_[cm]", "Width_[cm]", "Height_[cm]"])
     df["Conversion_factor"] = [conversion_factor] * len(df)
     df = multiply_and_round(df)
-
     return df
 
 
+def get_element_extents(file, elements):
+    """
+    Get the X, Y and Z extents of elements in model length units, keyed by GlobalId.
+    Dimensions from IfcBoundingBox items are used as they are. Elements whose body is a
+    single IfcMappedItem share one tessellation per IfcRepresentationMap, all other
+    elements are tessellated together in one multi-core geometry iterator run.
+    """
+    extents = {}
+    mapped_elements = {}
+    elements_to_tessellate = []
+    for element in elements:
+        bounding_box_extents = get_IfcBoundingBox_extents(element)
+        mapped_item = get_body_mapped_item(element)
+        if bounding_box_extents:
+            extents[element.GlobalId] = bounding_box_extents
+        elif mapped_item:
+            mapped_elements.setdefault(mapped_item.MappingSource.id(), []).append((element, mapped_item))
+        else:
+            elements_to_tessellate.append(element)
+    for mapped_items in mapped_elements.values():
+        mapped_extents = get_mapped_extents(mapped_items)
+        if mapped_extents is None:
+            elements_to_tessellate.extend(element for element, _ in mapped_items)
+        else:
+            extents.update(mapped_extents)
+    if elements_to_tessellate:
+        extents.update(get_tessellated_extents(file, elements_to_tessellate))
+    return extents
+
+
+def get_IfcBoundingBox_extents(element):
+    for rep in element.Representation.Representations:
+        if rep.is_a("IfcShapeRepresentation"):
+            for item in rep.Items:
+                if item.is_a("IfcBoundingBox"):
+                    return item.XDim, item.YDim, item.ZDim
+    return None
+
+
+def get_body_mapped_item(element):
+    for rep in element.Representation.Representations:
+        if rep.is_a("IfcShapeRepresentation") and rep.RepresentationIdentifier == "Body":
+            if len(rep.Items) == 1 and rep.Items[0].is_a("IfcMappedItem"):
+                if rep.Items[0].MappingTarget.is_a("IfcCartesianTransformationOperator3D"):
+                    return rep.Items[0]
+            return None
+    return None
+
+
+def get_mapped_extents(mapped_items):
+    """
+    Tessellate the shared IfcRepresentationMap once, then get the extents of every
+    occurrence by applying its mapping transform to the shared vertices
+    """
+    mapping_source = mapped_items[0][1].MappingSource
+    try:
+        geometry = ifcopenshell.geom.create_shape(get_geometry_settings(), mapping_source.MappedRepresentation)
+    except RuntimeError:
+        return None
+    vertices = np.asarray(geometry.verts, dtype="float64").reshape(-1, 3)
+    origin_matrix = ifcopenshell.util.placement.get_axis2placement(mapping_source.MappingOrigin)
+
+    extents = {}
+    for element, mapped_item in mapped_items:
+        matrix = get_cartesian_transformation_matrix(mapped_item.MappingTarget) @ origin_matrix
+        extents[element.GlobalId] = get_vertex_extents(vertices @ matrix[:3, :3].T + matrix[:3, 3])
+    return extents
+
+
+def get_cartesian_transformation_matrix(operator):
+    # 4x4 matrix of an IfcCartesianTransformationOperator3D, including (non-uniform) scale
+    z_axis = np.array(operator.Axis3.DirectionRatios if operator.Axis3 else (0.0, 0.0, 1.0), dtype="float64")
+    x_axis = np.array(operator.Axis1.DirectionRatios if operator.Axis1 else (1.0, 0.0, 0.0), dtype="float64")
+    z_axis /= np.linalg.norm(z_axis)
+    x_axis -= x_axis.dot(z_axis) * z_axis
+    x_axis /= np.linalg.norm(x_axis)
+    y_axis = np.cross(z_axis, x_axis)
+    scale = operator.Scale if operator.Scale is not None else 1.0
+    scale_y = getattr(operator, "Scale2", None) or scale
+    scale_z = getattr(operator, "Scale3", None) or scale
+
+    matrix = np.eye(4)
+    matrix[:3, 0] = x_axis * scale
+    matrix[:3, 1] = y_axis * scale_y
+    matrix[:3, 2] = z_axis * scale_z
+    matrix[:3, 3] = operator.LocalOrigin.Coordinates
+    return matrix
+
+
+def get_geometry_settings():
+    settings = ifcopenshell.geom.settings()
+    # Openings don't change the outer dimensions, results are kept in the model's length unit like IfcBoundingBox
+    settings.set(settings.DISABLE_OPENING_SUBTRACTIONS, True)
+    settings.set(settings.CONVERT_BACK_UNITS, True)
+    return settings
+
+
+def get_tessellated_extents(file, elements):
+    settings = get_geometry_settings()
+
+    extents = {}
+    geometry_extents = {}
+    iterator = ifcopenshell.geom.iterator(settings, file, multiprocessing.cpu_count(), include=elements)
+    if not iterator.initialize():
+        return extents
+    while True:
+        shape = iterator.get()
+        geometry = shape.geometry
+        if geometry.id not in geometry_extents:
+            geometry_extents[geometry.id] = get_vertex_extents(geometry.verts)
+        extents[shape.guid] = geometry_extents[geometry.id]
+        if not iterator.next():
+            break
+    for element in elements:
+        if element.GlobalId not in extents:
+            print(f"Failed to process representation for element {element.GlobalId}. Skipping.")
+    return extents
+
+
+def get_vertex_extents(verts):
+    vertices = np.asarray(verts, dtype="float64").reshape(-1, 3)
+    if not len(vertices):
+        return None, None, None
+    x, y, z = vertices.max(axis=0) - vertices.min(axis=0)
+    return float(x), float(y), float(z)
+
+
 def get_length_unit_and_conversion_factor(ifc_file):
     # Fetch the IfcProject entity (assuming there's only one in the file)
     project = ifc_file.by_type("IfcProject")[0]
@@ -1,131 +1,132 @@
+import argparse
 import csv
+import json
 import streamlit as st
 import ifcopenshell
 import ifcopenshell.util
-from ifcopenshell.util.selector import Selector
-import ifcopenshell.util.placement 
-import ifcopenshell.api
-import numpy as np
 import tempfile
-from vendor import ifcpatch
 import os
 import time
 import sys
+from datetime import datetime
 
-sys.path.append('./vendor')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from streamlit import runtime
+from tools import explode
 
-def list_of_IfcEntities_from_CSV():
+# Run headless with: python tools/ExtractAll.py model.ifc --output <directory> --processes <count>
+DEFAULT_SAVE_DIR = os.environ.get("DUNGBEETLE_EXTRACT_DIR", os.path.join(tempfile.gettempdir(), "Extracted"))
+
+def list_of_IfcEntities_from_CSV(csv_file_name='ifcentities.csv'):
     csv_entities = set()
-    with open('ifcentities.csv', 'r') as csvfile:
+    with open(csv_file_name, 'r', encoding='utf-8-sig') as csvfile:
         reader = csv.reader(csvfile)
         for row in reader:
             csv_entities.add(row[0])
     return csv_entities
 
-def move_to_origin(ifc_file, guid):
-    part = ifc_file.by_guid(guid)
-    new_matrix = np.eye(4)
-    ifcopenshell.api.run("geometry.edit_object_placement", ifc_file, product=part, matrix=new_matrix)
-    return ifc_file
-
-def move_storey_to_origin(ifc_file, storey):
-    new_matrix = np.eye(4)
-    storey.Name = "Floor plan"
-    ifcopenshell.api.run("geometry.edit_object_placement", ifc_file, product=storey, matrix=new_matrix)
-    return ifc_file
-
-def move_site_origin_to_000(ifc_file):
-    site = ifc_file.by_type("IfcSite")[0]
-    new_matrix = np.eye(4)
-    ifcopenshell.api.run("geometry.edit_object_placement", ifc_file, product=site, matrix=new_matrix)
-    return ifc_file
-
-def move_building_origin_to_000(ifc_file):
-    building = ifc_file.by_type("IfcBuilding")[0]
-    building.Name = "Dung Beetle - Digital Material Warehouse"
-    new_matrix = np.eye(4)
-    ifcopenshell.api.run("geometry.edit_object_placement", ifc_file, product=building, matrix=new_matrix)
-    return ifc_file
-
-def change_project_name(ifc_file):
-    project = ifc_file.by_type("IfcProject")[0]
-    project.Name = "Dung Beetle - Digital Material Warehouse"
-    return ifc_file
-
-def change_site_name(ifc_file):
-    site = ifc_file.by_type("IfcSite")[0]
-    site.Name = "Dung Beetle - Digital Material Warehouse"
-    return ifc_file
-
-def extract_and_save_element(ifc_file, guid, save_dir, original_filename):
-    extracted_ifc = ifcpatch.execute({"input": ifc_file, "file": ifc_file, "recipe": "ExtractElements", "arguments": [f"{guid}"]})
-    extracted_ifc = move_to_origin(extracted_ifc, guid)
-    extracted_ifc = move_site_origin_to_000(extracted_ifc)
-    extracted_ifc = move_building_origin_to_000(extracted_ifc)
-    extracted_ifc = change_project_name(extracted_ifc)
-    extracted_ifc = change_site_name(extracted_ifc)
-    # Adjust IfcStorey - move to 0,0,0 and rename to "Floor plans"
-    z_min = 0.0  # Storey elevation we want to move our extracted file
-    storey = extracted_ifc.by_type("IfcBuildingStorey")[0]
-    extracted_ifc = move_storey_to_origin(extracted_ifc, storey)
-    # Ensure the bottom edge of storey is located at 0,0
-    storey.Elevation = z_min
-    temp_file_path = os.path.join(save_dir, f"{original_filename}_{guid}.ifc")
-    extracted_ifc.write(temp_file_path)
-
-save_dir = r"C:\Users\Piotr\Extracted"
-
-st.title('BIMease: extract all products')
-
-st.markdown("""
-This app will extract all products from your IFC file and save these as independent IFC files
-""")
-
-csv_entities = list_of_IfcEntities_from_CSV()
-
-uploaded_file = st.file_uploader("Choose an IFC file", type=['ifc'])
-
-
-if uploaded_file:
-    original_filename = uploaded_file.name.split('.')[0]
-    
-    with st.spinner("Your products are being extracted..."):
-        time.sleep(2)
-        tfile = tempfile.NamedTemporaryFile(delete=False) 
-        tfile.write(uploaded_file.read())
-        temp_path = tfile.name
-        ifc = ifcopenshell.open(tfile.name)
-
-        # Get all IfcElement instances and populate the set with their types
-        # all_elements = ifc.by_type("IfcElement")
-
-        # Check what IfcEntity types exist in the Ifc file
-        unique_entity_types = set()
-
-        # Iterate through IFC file to check available IfcEntities, append them to unique_entity_types 
-        for entity in ifc:
-            unique_entity_types.add(entity.is_a())  # 'is_a' gives the type of the entity
-
-        # DEBUGGING
-        st.write(unique_entity_types)
-
-        all_elements = []
-        for entity_type in unique_entity_types:
-            if entity_type in csv_entities:
-                elements_of_type = ifc.by_type(entity_type)
-                all_elements.extend(elements_of_type)
-
-        # Create a set to store unique IfcElement types in the file
-        unique_element_types = set()
-
-        for elem in all_elements:
-            unique_element_types.add(elem.is_a())
-
-        # Loop through each unique IfcElement type to extract and save elements
-        for element_type in unique_element_types:
-            elements = ifc.by_type(element_type)
-            for element in elements:
-                guid = element.GlobalId
-                extract_and_save_element(ifc, guid, save_dir, original_filename)
-
-        st.write(f"All elements have been extracted and saved.")
\ No newline at end of file
+def get_guids_to_extract(ifc, csv_entities):
+    # Check what IfcEntity types exist in the Ifc file and keep the ones listed in the CSV
+    unique_element_types = {entity.is_a() for entity in ifc if entity.is_a() in csv_entities}
+    guids = []
+    for element_type in sorted(unique_element_types):
+        guids.extend(element.GlobalId for element in ifc.by_type(element_type, include_subtypes=False))
+    return guids
+
+def extract_all(ifc_path, save_dir, original_filename, csv_entities, processes=None):
+    """
+    Extract all products of the IFC file into save_dir, using a pool of worker processes that
+    each open the model once. Writes and returns a manifest of the extracted files and timings.
+    """
+    started = datetime.now()
+    start = time.perf_counter()
+    os.makedirs(save_dir, exist_ok=True)
+    processes = processes or os.cpu_count() or 1
+
+    ifc = ifcopenshell.open(ifc_path)
+    guids = get_guids_to_extract(ifc, csv_entities)
+    listing_seconds = time.perf_counter() - start
+
+    if processes == 1:
+        # No worker to start, the model is already open
+        results = list(explode.iter_explode(ifc, guids, save_dir, original_filename))
+    else:
+        del ifc
+        results = list(explode.explode_model(ifc_path, guids, save_dir, original_filename, processes=processes))
+
+    wall_seconds = time.perf_counter() - start
+    element_seconds = sum(result["seconds"] for result in results)
+    manifest = {
+        "source": os.path.abspath(ifc_path),
+        "output_directory": os.path.abspath(save_dir),
+        "started": started.isoformat(timespec="seconds"),
+        "processes": processes,
+        "elements": len(guids),
+        "extracted": sum(1 for result in results if result["error"] is None),
+        "failed": [{"guid": result["guid"], "error": result["error"]} for result in results if result["error"] is not None],
+        "listing_seconds": round(listing_seconds, 3),
+        "wall_seconds": round(wall_seconds, 3),
+        "element_seconds": round(element_seconds, 3),
+        # How much faster than writing the same elements one after the other
+        "speedup": round(element_seconds / wall_seconds, 2) if wall_seconds else None,
+        "components": [
+            {"guid": result["guid"], "file": result["file"], "bytes": result["bytes"], "seconds": round(result["seconds"], 4)}
+            for result in sorted(results, key=lambda result: result["guid"]) if result["error"] is None
+        ],
+    }
+    with open(os.path.join(save_dir, f"{original_filename}_manifest.json"), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    return manifest
+
+def format_summary(manifest):
+    return (
+        f"{manifest['extracted']} of {manifest['elements']} elements extracted in {manifest['wall_seconds']} s"
+        f" with {manifest['processes']} processes ({manifest['speedup']}x), {len(manifest['failed'])} failed"
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract all products of an IFC file as independent IFC files")
+    parser.add_argument("ifc_path")
+    parser.add_argument("--output", default=DEFAULT_SAVE_DIR, help="directory the extracted IFC files and the manifest are written to")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--entities", default="ifcentities.csv", help="CSV file listing the IfcEntities to extract")
+    args = parser.parse_args(argv)
+    original_filename = os.path.splitext(os.path.basename(args.ifc_path))[0]
+    manifest = extract_all(args.ifc_path, args.output, original_filename, list_of_IfcEntities_from_CSV(args.entities), args.processes)
+    print(format_summary(manifest))
+    print(f"Manifest: {os.path.join(args.output, original_filename + '_manifest.json')}")
+
+def streamlit_app():
+    st.title('BIMease: extract all products')
+
+    st.markdown("""
+    This app will extract all products from your IFC file and save these as independent IFC files
+    """)
+
+    csv_entities = list_of_IfcEntities_from_CSV()
+
+    save_dir = st.text_input("Output directory", DEFAULT_SAVE_DIR)
+    processes = st.number_input("Worker processes", min_value=1, max_value=os.cpu_count() or 1, value=os.cpu_count() or 1)
+
+    uploaded_file = st.file_uploader("Choose an IFC file", type=['ifc'])
+
+    if uploaded_file:
+        original_filename = uploaded_file.name.split('.')[0]
+
+        with st.spinner("Your products are being extracted..."):
+            tfile = tempfile.NamedTemporaryFile(delete=False, suffix=".ifc")
+            tfile.write(uploaded_file.read())
+            tfile.close()
+            manifest = extract_all(tfile.name, save_dir, original_filename, csv_entities, processes)
+            os.remove(tfile.name)
+
+            st.write("All elements have been extracted and saved. " + format_summary(manifest))
+            if manifest["failed"]:
+                st.dataframe(manifest["failed"])
+
+# Worker processes started with "spawn" import this file as __mp_main__ and must not run the app
+if __name__ == "__main__":
+    if runtime.exists():
+        streamlit_app()
+    else:
+        main()
@@ -0,0 +1,79 @@
+import sys
+import threading
+from collections import OrderedDict
+
+
+# ========== Process-wide LRU cache with versioned entries ==========
+
+
+def get_size(value):
+    """Approximate memory footprint of a cached value in bytes"""
+    if hasattr(value, "memory_usage"):
+        # pandas objects: deep=True counts the strings held in object columns
+        memory_usage = value.memory_usage(deep=True)
+        return int(memory_usage.sum()) if hasattr(memory_usage, "sum") else int(memory_usage)
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    Thread-safe cache shared by all sessions of the process. Every entry remembers the
+    version it was loaded at (e.g. a manifest generation), get() only returns it while
+    that version is current. The least recently used entries are evicted once max_bytes is exceeded.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, version=None, size=None):
+        size = get_size(value) if size is None else size
+        with self.lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return value
+            self.entries[key] = (version, value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+        return value
+
+    def get_or_load(self, key, version, load):
+        value = self.get(key, version)
+        if value is None:
+            value = self.put(key, load(), version)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def get_statistics(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.total_bytes, "hits": self.hits, "misses": self.misses}
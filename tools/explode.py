@@ -0,0 +1,245 @@
+import ifcopenshell
+import ifcopenshell.guid
+import ifcopenshell.util.placement
+import numpy as np
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+# ========== Explode a model into one IFC file per component ==========
+
+WAREHOUSE_NAME = "Dung Beetle - Digital Material Warehouse"
+STOREY_NAME = "Floor plan"
+
+
+class EntityCopier:
+    """
+    Copy entities from one IFC file into another. memo maps ids of the source file to
+    entities already in the target file, so shared entities (units, contexts, owner history,
+    representation maps) are copied once and can be mapped to existing ones in advance.
+    """
+
+    def __init__(self, target, memo=None):
+        self.target = target
+        self.memo = memo if memo is not None else {}
+        self.copied = []
+
+    def copy(self, entity, **overrides):
+        # Typed values like IfcLabel("...") in a select have no id and are never shared
+        if entity.id() and not overrides and entity.id() in self.memo:
+            return self.memo[entity.id()]
+        new_entity = self.target.create_entity(entity.is_a())
+        if entity.id() and not overrides:
+            self.memo[entity.id()] = new_entity
+            self.copied.append(entity)
+        attribute_names = entity.wrapped_data.get_attribute_names() if overrides else None
+        for index, value in enumerate(entity):
+            # Unset and derived attributes read as None
+            if value is None or (overrides and attribute_names[index] in overrides):
+                continue
+            new_entity[index] = self.copy_value(value)
+        for name, value in overrides.items():
+            setattr(new_entity, name, value)
+        return new_entity
+
+    def copy_value(self, value):
+        if isinstance(value, ifcopenshell.entity_instance):
+            return self.copy(value)
+        if isinstance(value, tuple):
+            return tuple(self.copy_value(item) for item in value)
+        return value
+
+    def copy_attachments(self):
+        """Copy what refers to the copied entities without being referenced by them: styles, material colours and properties"""
+        position = 0
+        while position < len(self.copied):
+            entity = self.copied[position]
+            position += 1
+            if entity.is_a("IfcRepresentationItem"):
+                for styled_item in getattr(entity, "StyledByItem", ()) or ():
+                    self.copy(styled_item)
+            elif entity.is_a("IfcMaterial"):
+                for material_representation in getattr(entity, "HasRepresentation", ()) or ():
+                    self.copy(material_representation)
+                for material_properties in getattr(entity, "HasProperties", ()) or ():
+                    self.copy(material_properties)
+
+
+class ComponentExploder:
+    """
+    Write elements of a model as independent IFC files. The project, its units, contexts and
+    owner history, and a site, building and storey at the origin are built once as a skeleton.
+    Every component file starts from a parsed copy of the skeleton and only the element itself,
+    its parts, type, property sets, materials and styles are copied into it, placed at the origin.
+    """
+
+    def __init__(self, ifc_file):
+        self.ifc_file = ifc_file
+        skeleton = ifcopenshell.file(schema=ifc_file.schema)
+        copier = EntityCopier(skeleton)
+
+        owner_histories = ifc_file.by_type("IfcOwnerHistory")
+        owner_history = copier.copy(owner_histories[0]) if owner_histories else None
+        for other_owner_history in owner_histories[1:]:
+            copier.memo[other_owner_history.id()] = owner_history
+
+        project = copier.copy(ifc_file.by_type("IfcProject")[0])
+        project.Name = WAREHOUSE_NAME
+        for context in ifc_file.by_type("IfcGeometricRepresentationContext"):
+            copier.copy(context)
+
+        site_placement = create_local_placement(skeleton)
+        site = copy_spatial_element(copier, ifc_file, "IfcSite", owner_history, Name=WAREHOUSE_NAME, ObjectPlacement=site_placement, Representation=None)
+        building_placement = create_local_placement(skeleton, site_placement)
+        building = copy_spatial_element(copier, ifc_file, "IfcBuilding", owner_history, Name=WAREHOUSE_NAME, ObjectPlacement=building_placement, Representation=None)
+        storey_placement = create_local_placement(skeleton, building_placement)
+        storey = copy_spatial_element(
+            copier, ifc_file, "IfcBuildingStorey", owner_history, Name=STOREY_NAME, ObjectPlacement=storey_placement, Representation=None, Elevation=0.0
+            )
+        for relating_object, related_object in [(project, site), (site, building), (building, storey)]:
+            skeleton.createIfcRelAggregates(ifcopenshell.guid.new(), owner_history, None, None, relating_object, [related_object])
+
+        self.skeleton_string = skeleton.to_string()
+        self.shared_ids = {source_id: entity.id() for source_id, entity in copier.memo.items()}
+        self.owner_history_id = owner_history.id() if owner_history else None
+        self.storey_id = storey.id()
+        self.storey_placement_id = storey_placement.id()
+
+    def create_component(self, element):
+        """Return a new ifcopenshell.file holding element at the origin, contained in the skeleton storey"""
+        component = ifcopenshell.file.from_string(self.skeleton_string)
+        copier = EntityCopier(component, {source_id: component.by_id(target_id) for source_id, target_id in self.shared_ids.items()})
+        owner_history = component.by_id(self.owner_history_id) if self.owner_history_id else None
+
+        element_placement = create_local_placement(component, component.by_id(self.storey_placement_id))
+        new_element = self.copy_object(copier, element, owner_history, ObjectPlacement=element_placement)
+        self.copy_parts(copier, element, new_element, owner_history)
+        copier.copy_attachments()
+
+        component.createIfcRelContainedInSpatialStructure(
+            ifcopenshell.guid.new(), owner_history, None, None, [new_element], component.by_id(self.storey_id)
+            )
+        return component
+
+    def copy_object(self, copier, element, owner_history, **overrides):
+        new_element = copier.copy(element, **overrides)
+        copier.memo[element.id()] = new_element
+        # Property sets and types (IsDefinedBy in IFC2X3, IsTypedBy in IFC4), materials and classifications
+        relationships = list(getattr(element, "IsDefinedBy", ()) or ()) + list(getattr(element, "IsTypedBy", ()) or ())
+        relationships += list(getattr(element, "HasAssociations", ()) or ())
+        for relationship in relationships:
+            # Types shared by the element and its parts get their materials once
+            new_type = relationship.is_a("IfcRelDefinesByType") and relationship.RelatingType.id() not in copier.memo
+            copier.copy(relationship, GlobalId=ifcopenshell.guid.new(), OwnerHistory=owner_history, RelatedObjects=[new_element])
+            if new_type:
+                element_type = relationship.RelatingType
+                for type_relationship in getattr(element_type, "HasAssociations", ()) or ():
+                    copier.copy(
+                        type_relationship, GlobalId=ifcopenshell.guid.new(), OwnerHistory=owner_history, RelatedObjects=[copier.copy(element_type)]
+                        )
+        return new_element
+
+    def copy_parts(self, copier, element, new_element, owner_history):
+        # Parts (e.g. IfcBuildingElementPart layers) keep their position relative to the element
+        element_matrix = get_placement_matrix(element)
+        for relationship in getattr(element, "IsDecomposedBy", ()) or ():
+            new_parts = []
+            for part in relationship.RelatedObjects:
+                relative_matrix = np.linalg.inv(element_matrix) @ get_placement_matrix(part)
+                part_placement = create_local_placement(copier.target, new_element.ObjectPlacement, relative_matrix)
+                new_part = self.copy_object(copier, part, owner_history, ObjectPlacement=part_placement)
+                self.copy_parts(copier, part, new_part, owner_history)
+                new_parts.append(new_part)
+            copier.target.createIfcRelAggregates(ifcopenshell.guid.new(), owner_history, None, None, new_element, new_parts)
+
+    def write_component(self, guid, save_dir, original_filename):
+        extracted_file_name = f"{original_filename}_{guid}.ifc"
+        extracted_file_path = os.path.join(save_dir, extracted_file_name)
+        self.create_component(self.ifc_file.by_guid(guid)).write(extracted_file_path)
+        return extracted_file_path, extracted_file_name
+
+
+def copy_spatial_element(copier, ifc_file, ifc_class, owner_history, **overrides):
+    # The first spatial element of the model keeps its attributes (addresses, site coordinates), a new one is made otherwise
+    elements = ifc_file.by_type(ifc_class)
+    if elements:
+        new_element = copier.copy(elements[0], **overrides)
+        for element in elements:
+            copier.memo[element.id()] = new_element
+        return new_element
+    return copier.target.create_entity(ifc_class, GlobalId=ifcopenshell.guid.new(), OwnerHistory=owner_history, **overrides)
+
+
+def get_placement_matrix(element):
+    if getattr(element, "ObjectPlacement", None) is None:
+        return np.eye(4)
+    return ifcopenshell.util.placement.get_local_placement(element.ObjectPlacement)
+
+
+def create_local_placement(ifc_file, relative_to=None, matrix=None):
+    if matrix is None or np.allclose(matrix, np.eye(4)):
+        axis = ifc_file.createIfcAxis2Placement3D(ifc_file.createIfcCartesianPoint((0.0, 0.0, 0.0)), None, None)
+    else:
+        axis = ifc_file.createIfcAxis2Placement3D(
+            ifc_file.createIfcCartesianPoint(tuple(float(value) for value in matrix[:3, 3])),
+            ifc_file.createIfcDirection(tuple(float(value) for value in matrix[:3, 2])),
+            ifc_file.createIfcDirection(tuple(float(value) for value in matrix[:3, 0])),
+            )
+    return ifc_file.createIfcLocalPlacement(relative_to, axis)
+
+
+# ========== Exploding in several processes ==========
+
+
+def write_components(exploder, guids, save_dir, original_filename):
+    """
+    Write the components one by one, yielding a result per GUID as soon as it is written.
+    An element that can't be exploded is reported with its error instead of stopping the run.
+    """
+    for guid in guids:
+        start = time.perf_counter()
+        result = {"guid": guid, "file": None, "path": None, "bytes": 0, "seconds": 0.0, "error": None}
+        try:
+            result["path"], result["file"] = exploder.write_component(guid, save_dir, original_filename)
+            result["bytes"] = os.path.getsize(result["path"])
+        except Exception as error:
+            result["error"] = repr(error)
+        result["seconds"] = time.perf_counter() - start
+        yield result
+
+
+def iter_explode(ifc_file, guids, save_dir, original_filename):
+    return write_components(ComponentExploder(ifc_file), guids, save_dir, original_filename)
+
+
+# Each worker process parses the model and builds the skeleton once, for all the shards it gets
+_worker_exploder = None
+
+
+def init_worker(ifc_path):
+    global _worker_exploder
+    _worker_exploder = ComponentExploder(ifcopenshell.open(ifc_path))
+
+
+def explode_worker_shard(guids, save_dir, original_filename):
+    return list(write_components(_worker_exploder, guids, save_dir, original_filename))
+
+
+def split_into_shards(guids, shard_size):
+    guids = list(guids)
+    return [guids[position:position + shard_size] for position in range(0, len(guids), shard_size)]
+
+
+def explode_model(ifc_path, guids, save_dir, original_filename, processes=None, shard_size=50):
+    """
+    Write the components of all guids using a pool of worker processes, yielding the results of
+    each shard as soon as it is finished. Small shards are handed out as workers become free,
+    so workers that got heavier elements don't hold up the others.
+    """
+    processes = processes or os.cpu_count() or 1
+    shards = split_into_shards(guids, shard_size)
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=(ifc_path,)) as executor:
+        futures = [executor.submit(explode_worker_shard, shard, save_dir, original_filename) for shard in shards]
+        for future in as_completed(futures):
+            yield from future.result()
@@ -0,0 +1,123 @@
+import hashlib
+import ifcopenshell
+import ifcopenshell.util.placement
+import json
+from datetime import datetime
+from tools.storage import NotFound
+
+
+# ========== Per-element fingerprints ==========
+
+# Values that change with every export without the element changing
+IGNORED_OBJECT_DATA = {"Express ID"}
+# Express ids of the property sets, quantity sets and material property sets
+IGNORED_NESTED_KEYS = {"id"}
+FLOAT_DIGITS = 6
+
+
+def strip_ids(value):
+    """Copy of nested object data without the express ids of its property sets"""
+    if isinstance(value, dict):
+        return {key: strip_ids(item) for key, item in value.items() if key not in IGNORED_NESTED_KEYS}
+    if isinstance(value, (list, tuple)):
+        return [strip_ids(item) for item in value]
+    return value
+
+
+class RepresentationHasher:
+    """
+    Hash geometry independently of entity ids, which change between exports of the same model.
+    Every entity is hashed from its class and attributes with references replaced by the
+    hashes of the referenced entities, so geometry shared through types is only hashed once.
+    """
+
+    def __init__(self):
+        self.hashes = {}
+
+    def hash_entity(self, entity):
+        if entity.id() and entity.id() in self.hashes:
+            return self.hashes[entity.id()]
+        digest = hashlib.sha256(entity.is_a().encode())
+        for value in entity:
+            digest.update(self.hash_value(value).encode())
+            digest.update(b"|")
+        entity_hash = digest.hexdigest()
+        if entity.id():
+            self.hashes[entity.id()] = entity_hash
+        return entity_hash
+
+    def hash_value(self, value):
+        if isinstance(value, ifcopenshell.entity_instance):
+            return self.hash_entity(value)
+        if isinstance(value, tuple):
+            return "(" + ",".join(self.hash_value(item) for item in value) + ")"
+        if isinstance(value, float):
+            return repr(round(value, FLOAT_DIGITS))
+        return repr(value)
+
+
+def get_element_fingerprint(element, object_data, hasher):
+    """
+    Fingerprint of an element from its extracted object data (attributes, property and quantity sets,
+    material), its placement and its representation
+    """
+    digest = hashlib.sha256()
+    stable_object_data = {key: strip_ids(value) for key, value in object_data.items() if key not in IGNORED_OBJECT_DATA}
+    digest.update(json.dumps(stable_object_data, sort_keys=True, default=str).encode())
+    if getattr(element, "ObjectPlacement", None) is not None:
+        matrix = ifcopenshell.util.placement.get_local_placement(element.ObjectPlacement)
+        digest.update(repr([round(float(value), FLOAT_DIGITS) for value in matrix.flatten()]).encode())
+    if getattr(element, "Representation", None) is not None:
+        digest.update(hasher.hash_entity(element.Representation).encode())
+    return digest.hexdigest()
+
+
+def diff_fingerprints(previous, current):
+    """Compare {GlobalId: {"fingerprint": ...}} records of two revisions of a project"""
+    changes = {"added": [], "changed": [], "unchanged": [], "removed": []}
+    for global_id, record in current.items():
+        if global_id not in previous:
+            changes["added"].append(global_id)
+        elif previous[global_id]["fingerprint"] != record["fingerprint"]:
+            changes["changed"].append(global_id)
+        else:
+            changes["unchanged"].append(global_id)
+    changes["removed"] = [global_id for global_id in previous if global_id not in current]
+    return changes
+
+
+def format_changes(changes):
+    return ", ".join(f"{len(changes[kind])} {kind}" for kind in ["added", "changed", "removed", "unchanged"])
+
+
+# ========== Stored fingerprints per Project ID ==========
+
+FINGERPRINT_PREFIX = "fingerprints/"
+# Fingerprints of the component files exploded into the IFC warehouse
+COMPONENT_FINGERPRINT_PREFIX = "component_fingerprints/"
+
+
+def fingerprint_blob_name(project_id, prefix=FINGERPRINT_PREFIX):
+    return f"{prefix}{project_id}.json"
+
+
+def load_fingerprints(bucket, project_id, prefix=FINGERPRINT_PREFIX):
+    """Fingerprints of the last ingested revision of the project, {} if it was never ingested"""
+    try:
+        return json.loads(bucket.get(fingerprint_blob_name(project_id, prefix)))["elements"]
+    except NotFound:
+        return {}
+
+
+def save_fingerprints(bucket, project_id, fingerprints, changes, prefix=FINGERPRINT_PREFIX):
+    """Store the fingerprints of a revision, removed elements are kept as tombstones with the date they were removed"""
+    try:
+        removed = json.loads(bucket.get(fingerprint_blob_name(project_id, prefix))).get("removed", {})
+    except NotFound:
+        removed = {}
+    now = datetime.now().isoformat(timespec="seconds")
+    removed.update({global_id: now for global_id in changes["removed"]})
+    for global_id in fingerprints:
+        removed.pop(global_id, None)
+    record = {"project_id": project_id, "updated": now, "elements": fingerprints, "removed": removed}
+    bucket.put(fingerprint_blob_name(project_id, prefix), json.dumps(record), content_type="application/json")
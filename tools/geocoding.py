@@ -0,0 +1,376 @@
+import abc
+import csv
+import numpy as np
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+try:
+    from geopy.exc import GeopyError
+    from geopy.extra.rate_limiter import RateLimiter
+    from geopy.geocoders import Nominatim
+except ImportError:
+    Nominatim = None
+
+try:
+    from pyproj import CRS, Transformer
+except ImportError:
+    Transformer = None
+
+
+# ========== Persistent geocoding cache ==========
+
+GEOCODE_CACHE_PATH = os.environ.get(
+    "DUNGBEETLE_GEOCODE_CACHE",
+    os.path.join(os.path.expanduser("~"), ".dungbeetle", "geocode_cache.sqlite")
+    )
+
+
+def normalize_address(address):
+    # Case, accents composition, whitespace and empty address parts (e.g. missing canton) don't change the key
+    address = unicodedata.normalize("NFKC", address or "").casefold()
+    parts = [re.sub(r"\s+", " ", part).strip() for part in address.split(",")]
+    return ", ".join(part for part in parts if part)
+
+
+class GeocodeCache:
+    """
+    SQLite cache of geocoded addresses keyed by normalized address and the backend that resolved
+    it. Only successful results are stored, so re-uploads of the same building never reach the geocoder.
+    """
+
+    def __init__(self, path=GEOCODE_CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # Rows of the former "geocodes" table don't say which backend resolved them and are not used
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS geocode_results (address TEXT, backend TEXT, latitude REAL, longitude REAL, altitude REAL, "
+            "PRIMARY KEY (address, backend));"
+            )
+        self.connection.commit()
+
+    def get(self, address, backend):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT latitude, longitude, altitude FROM geocode_results WHERE address = ? AND backend = ?;",
+                (normalize_address(address), backend),
+                ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row
+
+    def set(self, address, backend, point):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO geocode_results VALUES (?, ?, ?, ?, ?);", (normalize_address(address), backend, *point)
+                )
+            self.connection.commit()
+
+    def get_statistics(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# ========== Geocoder backends ==========
+
+PROJECT_ADDRESSES_PATH = os.path.join(os.path.dirname(__file__), "..", "warehouse", "Project_addresses_dataset.csv")
+# Town centroids of the project addresses, a larger table (e.g. all post codes) can be configured instead
+GAZETTEER_PLACES_PATH = os.environ.get(
+    "DUNGBEETLE_GAZETTEER_PLACES", os.path.join(os.path.dirname(__file__), "..", "warehouse", "Gazetteer_places.csv")
+    )
+
+
+class Geocoder(abc.ABC):
+    """Geocoder backend interface: geocode() returns (latitude, longitude, altitude) or None"""
+
+    name = "geocoder"
+
+    @abc.abstractmethod
+    def geocode(self, address):
+        pass
+
+
+class NominatimGeocoder(Geocoder):
+    name = "nominatim"
+
+    def __init__(self):
+        # One rate limiter per process, so the one second delay is respected across sessions
+        locator = Nominatim(user_agent="OpenMapQuest")
+        self.rate_limited_geocode = RateLimiter(locator.geocode, min_delay_seconds=1)
+
+    def geocode(self, address):
+        try:
+            location = self.rate_limited_geocode(address)
+        except GeopyError:
+            return None
+        return tuple(location.point) if location else None
+
+
+class GazetteerGeocoder(Geocoder):
+    """
+    Offline geocoder resolving addresses from local tables, indexed in dictionaries.
+    Project address datasets map known addresses to their post code and town, place
+    tables (columns "Post code", "Town", "latitude", "longitude") give the coordinates.
+    Address rows carrying their own latitude and longitude are resolved directly.
+    """
+
+    name = "gazetteer"
+
+    def __init__(self):
+        self.address_points = {}
+        self.address_places = {}
+        self.post_code_points = {}
+        self.town_points = {}
+
+    def load_project_addresses(self, path=PROJECT_ADDRESSES_PATH):
+        for row in read_csv_rows(path):
+            place = (row.get("Post code", "").strip(), normalize_address(row.get("Town")))
+            point = get_row_point(row)
+            for address in {row.get("Full address"), join_address(row)}:
+                if not address:
+                    continue
+                # Some rows repeat the full address of an earlier project, the first row naming an address wins
+                self.address_places.setdefault(normalize_address(address), place)
+                if point:
+                    self.address_points.setdefault(normalize_address(address), point)
+
+    def load_places(self, path):
+        for row in read_csv_rows(path):
+            point = get_row_point(row)
+            if not point:
+                continue
+            post_code = row.get("Post code", "").strip()
+            town = normalize_address(row.get("Town"))
+            if post_code:
+                self.post_code_points.setdefault(post_code, point)
+            if town:
+                self.town_points.setdefault(town, point)
+
+    def has_points(self):
+        return bool(self.address_points or self.post_code_points or self.town_points)
+
+    def geocode(self, address):
+        key = normalize_address(address)
+        if key in self.address_points:
+            return self.address_points[key]
+        post_code, town = self.address_places.get(key) or parse_place(key)
+        return self.post_code_points.get(post_code) or self.town_points.get(town)
+
+
+class CachedGeocoder(Geocoder):
+    """A backend whose results are kept in the geocode cache, keyed by address and the backend's name"""
+
+    def __init__(self, geocoder, cache):
+        self.geocoder = geocoder
+        self.cache = cache
+        self.name = geocoder.name
+
+    def geocode(self, address):
+        point = self.cache.get(address, self.name)
+        if point is None:
+            point = self.geocoder.geocode(address)
+            if point:
+                self.cache.set(address, self.name, tuple(point))
+        return point
+
+
+class ChainGeocoder(Geocoder):
+    """Ask several geocoder backends in order, the first result wins"""
+
+    name = "chain"
+
+    def __init__(self, geocoders):
+        self.geocoders = list(geocoders)
+
+    def geocode(self, address):
+        for geocoder in self.geocoders:
+            point = geocoder.geocode(address)
+            if point:
+                return point
+        return None
+
+
+def read_csv_rows(path):
+    with open(path, "r", encoding="utf-8-sig", newline="") as csvfile:
+        return list(csv.DictReader(csvfile))
+
+
+def get_row_point(row):
+    try:
+        return float(row["latitude"]), float(row["longitude"]), float(row.get("altitude") or 0.0)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def join_address(row):
+    parts = [row.get(column, "") for column in ["Street", "Post code", "Town", "Canton", "Country"]]
+    return ", ".join(part for part in parts if part)
+
+
+def parse_place(normalized_address):
+    # Addresses are written as "street, post code, town, canton, country"
+    parts = normalized_address.split(", ")
+    for position, part in enumerate(parts):
+        if re.fullmatch(r"\d{4,5}", part):
+            town = parts[position + 1] if position + 1 < len(parts) else ""
+            return part, town
+    return "", ""
+
+
+def create_gazetteer(places_path=GAZETTEER_PLACES_PATH):
+    gazetteer = GazetteerGeocoder()
+    if os.path.exists(PROJECT_ADDRESSES_PATH):
+        gazetteer.load_project_addresses(PROJECT_ADDRESSES_PATH)
+    if places_path and os.path.exists(places_path):
+        gazetteer.load_places(places_path)
+    return gazetteer
+
+
+# ========== IFC site georeferencing ==========
+
+
+def compound_angle_to_degrees(angle):
+    # IfcCompoundPlaneAngleMeasure: degrees, minutes, seconds and optionally millionths of a second, all with the same sign
+    if not angle:
+        return None
+    factors = [1, 60, 3600, 3600 * 1e6]
+    return sum(component / factor for component, factor in zip(angle, factors))
+
+
+def get_site_geocoordinates(ifc_file):
+    """
+    Return (latitude, longitude, altitude) from the georeferencing stored in the IFC file,
+    IfcMapConversion first, then IfcSite RefLatitude/RefLongitude, or None if there is none.
+    """
+    return get_map_conversion_geocoordinates(ifc_file) or get_ref_latitude_geocoordinates(ifc_file)
+
+
+def get_ref_latitude_geocoordinates(ifc_file):
+    for site in ifc_file.by_type("IfcSite"):
+        latitude = compound_angle_to_degrees(site.RefLatitude)
+        longitude = compound_angle_to_degrees(site.RefLongitude)
+        # Many authoring tools write 0° 0' 0" when the site was never georeferenced
+        if latitude is None or longitude is None or (latitude == 0 and longitude == 0):
+            continue
+        altitude = site.RefElevation * get_unit_scale(ifc_file) if site.RefElevation is not None else 0.0
+        return latitude, longitude, altitude
+    return None
+
+
+def get_map_conversion_geocoordinates(ifc_file):
+    # Converting projected map coordinates requires pyproj (installed with geopandas)
+    if Transformer is None or ifc_file.schema == "IFC2X3":
+        return None
+    project_unit_scale = get_unit_scale(ifc_file)
+    x, y, z = get_site_location(ifc_file)
+    for map_conversion in ifc_file.by_type("IfcMapConversion"):
+        target_crs = map_conversion.TargetCRS
+        if not target_crs or not target_crs.Name:
+            continue
+        # Eastings, Northings and OrthogonalHeight are in map units, the project's length unit if the CRS has none
+        map_unit = getattr(target_crs, "MapUnit", None)
+        map_unit_scale = get_length_unit_scale(map_unit) if map_unit else project_unit_scale
+        # Scale converts project lengths to map units, without it the units alone are converted
+        scale = map_conversion.Scale or project_unit_scale / map_unit_scale
+        axis_x, axis_y = map_conversion.XAxisAbscissa or 1.0, map_conversion.XAxisOrdinate or 0.0
+        axis_length = np.hypot(axis_x, axis_y)
+        axis_x, axis_y = axis_x / axis_length, axis_y / axis_length
+        # Map coordinates of the site's origin, in metres
+        eastings = (map_conversion.Eastings + scale * (axis_x * x - axis_y * y)) * map_unit_scale
+        northings = (map_conversion.Northings + scale * (axis_y * x + axis_x * y)) * map_unit_scale
+        altitude = ((map_conversion.OrthogonalHeight or 0.0) + scale * z) * map_unit_scale
+        try:
+            crs = CRS.from_user_input(target_crs.Name)
+            # Metres per unit of the CRS's axes, e.g. US survey feet
+            crs_unit_scale = crs.axis_info[0].unit_conversion_factor if crs.axis_info else 1.0
+            transformer = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+            longitude, latitude = transformer.transform(eastings / crs_unit_scale, northings / crs_unit_scale)
+        except Exception:
+            continue
+        if np.isfinite(latitude) and np.isfinite(longitude):
+            return latitude, longitude, altitude
+    return None
+
+
+def get_site_location(ifc_file):
+    """Position of the first IfcSite in project coordinates and length units, the origin if there is none"""
+    import ifcopenshell.util.placement
+    for site in ifc_file.by_type("IfcSite"):
+        if site.ObjectPlacement:
+            return tuple(float(value) for value in ifcopenshell.util.placement.get_local_placement(site.ObjectPlacement)[:3, 3])
+    return 0.0, 0.0, 0.0
+
+
+def get_length_unit_scale(unit):
+    """Metres per unit of an IfcSIUnit or IfcConversionBasedUnit (e.g. the map unit of a projected CRS)"""
+    import ifcopenshell.util.unit
+    if unit.is_a("IfcConversionBasedUnit"):
+        factor = unit.ConversionFactor
+        return factor.ValueComponent.wrappedValue * get_length_unit_scale(factor.UnitComponent)
+    return ifcopenshell.util.unit.get_prefix_multiplier(unit.Prefix) if unit.Prefix else 1.0
+
+
+def get_unit_scale(ifc_file):
+    import ifcopenshell.util.unit
+    return ifcopenshell.util.unit.calculate_unit_scale(ifc_file)
+
+
+# ========== Geocoding ==========
+
+_geocode_cache = None
+_geocoder = None
+
+
+def get_geocode_cache():
+    global _geocode_cache
+    if _geocode_cache is None:
+        _geocode_cache = GeocodeCache()
+    return _geocode_cache
+
+
+def get_geocoder():
+    """
+    The process-wide geocoder: the offline gazetteer first, then Nominatim (with cached results)
+    when geopy is installed and DUNGBEETLE_GEOCODER isn't set to "offline"
+    """
+    global _geocoder
+    if _geocoder is None:
+        geocoders = []
+        gazetteer = create_gazetteer()
+        if gazetteer.has_points():
+            geocoders.append(gazetteer)
+        if Nominatim is not None and os.environ.get("DUNGBEETLE_GEOCODER", "") != "offline":
+            geocoders.append(CachedGeocoder(NominatimGeocoder(), get_geocode_cache()))
+        if not geocoders:
+            # Without a places table every address would be dropped for lack of coordinates
+            raise RuntimeError(
+                "Geocoding is offline but no places are configured, set DUNGBEETLE_GAZETTEER_PLACES to a CSV "
+                "with Post code, Town, latitude and longitude columns"
+                )
+        _geocoder = ChainGeocoder(geocoders)
+    return _geocoder
+
+
+def set_geocoder(geocoder):
+    global _geocoder
+    _geocoder = geocoder
+
+
+def get_project_point(ifc_file, complete_address):
+    """Coordinates of the project: the file's own georeferencing, geocoding the address only as a fallback"""
+    return get_site_geocoordinates(ifc_file) or geocode_address(complete_address)
+
+
+def geocode_address(complete_address):
+    """Return (latitude, longitude, altitude) of an address, NaN values if it can't be found"""
+    if not complete_address:
+        return np.nan, np.nan, np.nan
+    point = get_geocoder().geocode(complete_address)
+    return tuple(point) if point else (np.nan, np.nan, np.nan)
@@ -0,0 +1,38 @@
+import copy
+import functools
+import pandas as pd
+from st_aggrid import GridOptionsBuilder
+
+
+# ========== AgGrid options shared by tables with the same columns ==========
+
+
+@functools.lru_cache(maxsize=128)
+def build_grid_options(columns, dtypes, selection_mode="multiple"):
+    # GridOptionsBuilder only needs the columns and their types, not the rows
+    empty_df = pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in zip(columns, dtypes)})
+    gb = GridOptionsBuilder.from_dataframe(empty_df)
+    gb.configure_side_bar()
+    gb.configure_selection(selection_mode, use_checkbox=True, groupSelectsChildren="Group checkbox select children")
+    return gb.build()
+
+
+def get_grid_options(df, selection_mode="multiple"):
+    """Grid options of df, built once per column schema. AgGrid gets a copy it can modify"""
+    options = build_grid_options(tuple(df.columns), tuple(str(dtype) for dtype in df.dtypes), selection_mode)
+    return copy.deepcopy(options)
+
+
+def get_non_empty_columns(df):
+    """Columns with at least one value, the property and quantity set columns of other classes are mostly empty"""
+    return list(df.columns[df.notna().any()])
+
+
+def get_page(df, page, page_size):
+    """Rows of the 1-based page, only these are sent to the browser"""
+    start = (page - 1) * page_size
+    return df.iloc[start:start + page_size]
+
+
+def get_page_count(df, page_size):
+    return max((len(df) + page_size - 1) // page_size, 1)
@@ -6,49 +6,136 @@ import streamlit as st
 
 session = st.session_state
 
-def get_material_psets(object):
-    mat_psets = {}   
-    if Element.get_material(object):
-        IfcMaterial = Element.get_material(object)  
-        if IfcMaterial is not None:  
-            IfcMaterialProperties = IfcMaterial.HasProperties
-            amount_of_material_psets = list(range(0,len(IfcMaterial.HasProperties)))
-            for i in amount_of_material_psets:
-                mat_psets = Element.get_property_definition(IfcMaterialProperties[i])
-                st.session_state['mat_psets'] = mat_psets                
-    else:
-        mat_psets = {}
-        st.session_state['mat_psets'] = mat_psets    
+def get_material_psets(object, index=None):
+    """
+    Get the property set data of an object's material. When an index from
+    get_relationship_index is passed, each IfcMaterial is resolved only once per file
+    and all objects sharing it get the same dictionary, which must not be modified
+    """
+    if index is None:
+        IfcMaterial = Element.get_material(object)
+        return get_material_property_definition(IfcMaterial) if IfcMaterial else {}
+    IfcMaterial = get_indexed_material(index, object)
+    if IfcMaterial is None:
+        return {}
+    material_psets = index["material_psets"]
+    if IfcMaterial.id() not in material_psets:
+        material_psets[IfcMaterial.id()] = get_material_property_definition(IfcMaterial)
+    return material_psets[IfcMaterial.id()]
+
+def get_material_property_definition(IfcMaterial):
+    # Only the last of the material's property sets is kept
+    mat_psets = {}
+    for IfcMaterialProperties in getattr(IfcMaterial, "HasProperties", None) or []:
+        mat_psets = Element.get_property_definition(IfcMaterialProperties)
     return mat_psets
 
-def get_objects_data_by_class(file, class_type):
+def get_relationship_index(file):
+    """
+    Walk the relationship entities of a file once and build GUID-keyed lookup maps
+    for aggregates, spatial containers, types and materials. The index also caches
+    material property sets by IfcMaterial id, see get_material_psets
+    """
+    index = {"aggregate": {}, "container": {}, "type": {}, "material": {}, "material_psets": {}}
+    for rel in file.by_type("IfcRelAggregates"):
+        for related_object in rel.RelatedObjects:
+            index["aggregate"][related_object.GlobalId] = rel.RelatingObject
+    for rel in file.by_type("IfcRelContainedInSpatialStructure"):
+        for related_element in rel.RelatedElements:
+            index["container"].setdefault(related_element.GlobalId, rel.RelatingStructure)
+    for rel in file.by_type("IfcRelDefinesByType"):
+        for related_object in rel.RelatedObjects:
+            index["type"][related_object.GlobalId] = rel.RelatingType
+    for rel in file.by_type("IfcRelAssociatesMaterial"):
+        for related_object in rel.RelatedObjects:
+            index["material"].setdefault(related_object.GlobalId, rel.RelatingMaterial)
+    return index
+
+def get_indexed_aggregate(index, object):
+    return index["aggregate"].get(object.GlobalId)
+
+def get_indexed_container(index, object):
+    # Same as Element.get_container: elements which are part of an aggregate inherit the container of their parent
+    aggregate = get_indexed_aggregate(index, object)
+    if aggregate:
+        return get_indexed_container(index, aggregate)
+    return index["container"].get(object.GlobalId)
+
+def get_indexed_type(index, object):
+    return index["type"].get(object.GlobalId)
+
+def get_indexed_material(index, object, object_type=None):
+    # Same as Element.get_material: fall back to the material of the type object
+    material = index["material"].get(object.GlobalId)
+    if material is None:
+        object_type = object_type or get_indexed_type(index, object)
+        if object_type:
+            material = index["material"].get(object_type.GlobalId)
+    return material
+
+def get_indexed_predefined_type(object, object_type):
+    # Same as Element.get_predefined_type, without looking the type object up again
+    if object_type:
+        predefined_type = getattr(object_type, "PredefinedType", None)
+        if predefined_type == "USERDEFINED" or not predefined_type:
+            predefined_type = getattr(object_type, "ElementType", None)
+        if predefined_type and predefined_type != "NOTDEFINED":
+            return predefined_type
+    predefined_type = getattr(object, "PredefinedType", None)
+    if predefined_type == "USERDEFINED" or not predefined_type:
+        predefined_type = getattr(object, "ObjectType", None)
+    return predefined_type
+
+def get_object_psets_and_qtos(file, object):
+    # One Element.get_psets walk, split into property sets and quantity sets
+    psets, qtos = {}, {}
+    for name, definition in Element.get_psets(object).items():
+        entity = file.by_id(definition["id"])
+        if entity.is_a("IfcElementQuantity"):
+            qtos[name] = definition
+        elif entity.is_a("IfcPropertySet"):
+            psets[name] = definition
+    return psets, qtos
+
+def get_object_data(file, object, index):
+    aggregate = get_indexed_aggregate(index, object)
+    container = get_indexed_container(index, object)
+    object_type = get_indexed_type(index, object)
+    material = get_indexed_material(index, object, object_type)
+    psets, qtos = get_object_psets_and_qtos(file, object)
+    return {
+            "Express ID": object.id(),
+            "Global ID": object.GlobalId,
+            "Parent's GUID": aggregate.GlobalId
+            if aggregate
+            else "",
+            "Class": object.is_a(),
+            "PredefinedType": get_indexed_predefined_type(object, object_type),
+            "Name": object.Name,
+            "Level": container.Name
+            if container
+            else "",
+            "ObjectType": object_type.Name
+            if object_type
+            else "",
+            "QuantitySets": qtos,
+            "PropertySets": psets,
+            "Material": material.Name
+            if material
+            else "",
+            "MaterialPsets": get_material_psets(object, index)
+            if material
+            else "",
+    }
+
+def get_objects_data_by_class(file, class_type, index=None):
+    # Pass an index from get_relationship_index when extracting several classes from the same file
+    if index is None:
+        index = get_relationship_index(file)
     objects_data = []
     objects = file.by_type(class_type)
-    for object in objects:       
-        objects_data.append({
-                "Express ID": object.id(),
-                "Global ID": object.GlobalId,
-                "Parent's GUID": Element.get_aggregate(object).GlobalId
-                if Element.get_aggregate(object)
-                else "",             
-                "Class": object.is_a(),
-                "PredefinedType": Element.get_predefined_type(object),
-                "Name": object.Name,
-                "Level": Element.get_container(object).Name
-                if Element.get_container(object)
-                else "",
-                "ObjectType": Element.get_type(object).Name
-                if Element.get_type(object)
-                else "",                  
-                "QuantitySets": Element.get_psets(object, qtos_only=True),
-                "PropertySets": Element.get_psets(object, psets_only=True),
-                "Material": Element.get_material(object).Name
-                if Element.get_material(object)
-                else "", 
-                "MaterialPsets": get_material_psets(object)
-                if Element.get_material(object)
-                else "",
-        })       
+    for object in objects:
+        objects_data.append(get_object_data(file, object, index))
     return objects_data
 
 def get_attribute_value(object_data, attribute):
@@ -70,10 +157,82 @@ def get_attribute_value(object_data, attribute):
         else:
             return None
 
+def get_objects_dataframe_by_class(file, class_type, index=None):
+    # Same as create_pandas_dataframe(get_objects_data_by_class(...)), without keeping the list of rows
+    if index is None:
+        index = get_relationship_index(file)
+    builder = DataFrameBuilder()
+    for object in file.by_type(class_type):
+        builder.append(get_object_data(file, object, index))
+    return builder.build()
+
 def create_pandas_dataframe(data):
+    builder = DataFrameBuilder()
+    for object_data in data:
+        builder.append(object_data)
+    return builder.build()
+
+class DataFrameBuilder:
+    """
+    Collect object data column by column and build the DataFrame in one go.
+    Nested dictionaries become "PropertySets.X.Y" columns, like pd.json_normalize(data, sep='.').
+    Only the filled cells are stored; each column is created with its final dtype:
+    numeric QuantitySets as float64, repeated strings as categorical. Frames that are
+    stored or merged with other files' frames (the warehouse) use categorical=False.
+    """
+
+    def __init__(self, categorical=True):
+        self.columns = {}
+        self.length = 0
+        self.categorical = categorical
+
+    def append(self, object_data):
+        self.append_values(object_data, "")
+        self.length += 1
+
+    def append_values(self, data, prefix):
+        for key, value in data.items():
+            column_name = f"{prefix}{key}"
+            if isinstance(value, dict):
+                self.append_values(value, column_name + ".")
+                continue
+            column = self.columns.get(column_name)
+            if column is None:
+                column = self.columns[column_name] = ([], [])
+            column[0].append(self.length)
+            column[1].append(value)
+
+    def build(self):
+        import pandas as pd
+        columns = {
+            column_name: create_column(rows, values, self.length, column_name.startswith("QuantitySets."), self.categorical)
+            for column_name, (rows, values) in self.columns.items()
+        }
+        return pd.DataFrame(columns, index=pd.RangeIndex(self.length))
+
+def create_column(rows, values, length, is_quantity=False, categorical=True):
+    import numpy as np
     import pandas as pd
-    df = pd.json_normalize(data, sep='.')
-    return df
+    filled_values = [value for value in values if value is not None]
+    is_complete = len(filled_values) == length
+    if filled_values and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in filled_values):
+        if is_complete and not is_quantity and all(isinstance(value, int) for value in filled_values):
+            return np.array(values, dtype="int64")
+        column = np.full(length, np.nan, dtype="float64")
+        for row, value in zip(rows, values):
+            if value is not None:
+                column[row] = value
+        return column
+    if is_complete and filled_values and all(isinstance(value, bool) for value in filled_values):
+        return np.array(values, dtype="bool")
+    column = np.full(length, np.nan, dtype=object)
+    for row, value in zip(rows, values):
+        column[row] = value
+    # Low-cardinality strings (e.g. Material, Class, Level) store each distinct value once
+    if categorical and filled_values and all(isinstance(value, str) for value in filled_values):
+        if len(set(filled_values)) * 2 <= len(filled_values):
+            return pd.Categorical(column)
+    return column
 
 def get_stories(file):
     dict = []
@@ -0,0 +1,99 @@
+import ifcopenshell
+from tools import BoundingBox
+from tools import fingerprint
+from tools import ifchelper
+
+
+# ========== Single pass ingest of several IfcEntities ==========
+
+
+def ingest_elements(file, entities, index=None, get_object_data=ifchelper.get_object_data):
+    """
+    Extract object data and bounding box extents for all requested IfcEntities in one pass.
+    Every element is extracted once, even if it belongs to several of the entities, and all
+    elements are tessellated together. Returns per-entity DataFrames of object data and
+    per-entity dimension rows for BoundingBox.create_dimensions_dataframe.
+    get_object_data(file, element, index) can be replaced to customise the extracted rows.
+    """
+    dataframes, dimension_rows, _ = ingest_revision(file, entities, None, index, get_object_data)
+    return dataframes, dimension_rows
+
+
+def ingest_revision(file, entities, previous_fingerprints, index=None, get_object_data=ifchelper.get_object_data):
+    """
+    Like ingest_elements, but only elements that are new or changed since previous_fingerprints
+    ({GlobalId: {"fingerprint": ...}} of the project's last revision) are returned and tessellated.
+    Also returns the fingerprints of all elements of this revision, with the entities they belong to.
+    Without previous fingerprints (None) every element is returned.
+    """
+    if index is None:
+        index = ifchelper.get_relationship_index(file)
+    entities = list(entities)
+    # Warehouse frames are concatenated across files and stored, their strings stay object dtype
+    builders = {entity: ifchelper.DataFrameBuilder(categorical=False) for entity in entities}
+    dimension_rows = {entity: [] for entity in entities}
+
+    entities_by_class = {}
+    elements_with_representation = []
+    fingerprints = {}
+    hasher = fingerprint.RepresentationHasher()
+    for element in get_ingest_elements(file, entities):
+        ifc_class = element.is_a()
+        if ifc_class not in entities_by_class:
+            entities_by_class[ifc_class] = [entity for entity in entities if element.is_a(entity)]
+        element_entities = entities_by_class[ifc_class]
+        if not element_entities:
+            continue
+        object_data = get_object_data(file, element, index)
+        if previous_fingerprints is not None:
+            element_fingerprint = fingerprint.get_element_fingerprint(element, object_data, hasher)
+            fingerprints[element.GlobalId] = {"fingerprint": element_fingerprint, "entities": element_entities}
+            previous_record = previous_fingerprints.get(element.GlobalId)
+            if previous_record and previous_record["fingerprint"] == element_fingerprint:
+                continue
+        for entity in element_entities:
+            builders[entity].append(object_data)
+        if hasattr(element, "Representation") and element.Representation is not None:
+            elements_with_representation.append((element, element_entities))
+
+    extents = BoundingBox.get_element_extents(file, [element for element, _ in elements_with_representation])
+    for element, element_entities in elements_with_representation:
+        name = element.Name if element.Name else "N/A"
+        global_id = element.GlobalId if element.GlobalId else "N/A"
+        x, y, z = extents.get(element.GlobalId, (None, None, None))
+        for entity in element_entities:
+            dimension_rows[entity].append([name, global_id, x, y, z])
+
+    dataframes = {entity: builder.build() for entity, builder in builders.items()}
+    return dataframes, dimension_rows, fingerprints
+
+
+def get_ingest_elements(file, entities):
+    # All IfcElements, plus the instances of requested entities outside of IfcElement (e.g. IfcBuildingSystem)
+    elements = file.by_type("IfcElement")
+    schema = ifcopenshell.ifcopenshell_wrapper.schema_by_name(file.schema)
+    element_ids = set()
+    for entity in entities:
+        if is_element_class(schema, entity):
+            continue
+        try:
+            instances = file.by_type(entity)
+        except RuntimeError:
+            continue
+        for instance in instances:
+            if instance.id() not in element_ids:
+                element_ids.add(instance.id())
+                elements.append(instance)
+    return elements
+
+
+def is_element_class(schema, entity):
+    try:
+        declaration = schema.declaration_by_name(entity)
+    except RuntimeError:
+        return False
+    while declaration is not None:
+        if declaration.name() == "IfcElement":
+            return True
+        declaration = declaration.supertype()
+    return False
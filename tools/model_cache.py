@@ -0,0 +1,81 @@
+import ifcopenshell
+import os
+import threading
+from tools import cache
+from tools import ifchelper
+
+
+# ========== Parsed models shared across reruns, pages and sessions ==========
+
+MODEL_CACHE_BYTES = int(os.environ.get("DUNGBEETLE_MODEL_CACHE_MB", "2048")) * 1024 * 1024
+# A parsed ifcopenshell model takes several times the size of its file in memory
+MODEL_MEMORY_FACTOR = 8
+
+
+class CachedModel:
+    """
+    A parsed model with its relationship index and the DataFrames extracted from it, keyed by the
+    content hash of the file. Models are shared by every session that uploads the same file, so
+    callers must not modify them: copy a DataFrame before adding or changing columns.
+    ifcopenshell isn't thread-safe, ifc_file and relationship_index are only used while holding lock.
+    """
+
+    def __init__(self, content_hash, ifc_file, file_size):
+        self.content_hash = content_hash
+        self.ifc_file = ifc_file
+        self.file_size = file_size
+        self.relationship_index = ifchelper.get_relationship_index(ifc_file)
+        self.dataframes = {}
+        # Reentrant, derived DataFrames are built from the extracted ones
+        self.lock = threading.RLock()
+
+    def get_dataframe(self, class_type):
+        """Object data of all elements of class_type, extracted once per model"""
+        return self.get_derived(class_type, lambda model: ifchelper.get_objects_dataframe_by_class(
+            model.ifc_file, class_type, index=model.relationship_index
+            ))
+
+    def get_derived(self, name, build):
+        """
+        DataFrame built by build(model) once per model, e.g. a normalized copy of an extracted DataFrame.
+        build runs while holding the model's lock, so concurrent sessions never use the file at the same time.
+        """
+        with self.lock:
+            if name not in self.dataframes:
+                self.dataframes[name] = build(self)
+                # The model's footprint grew with the new DataFrame
+                get_model_cache().put(self.content_hash, self, size=self.get_size())
+            return self.dataframes[name]
+
+    def get_size(self):
+        return self.file_size * MODEL_MEMORY_FACTOR + sum(cache.get_size(df) for df in self.dataframes.values())
+
+
+_model_cache = None
+_model_cache_lock = threading.Lock()
+# Sessions uploading the same file at the same time parse it once
+_loading_locks = {}
+
+
+def get_model_cache():
+    global _model_cache
+    if _model_cache is None:
+        _model_cache = cache.LRUCache(MODEL_CACHE_BYTES)
+    return _model_cache
+
+
+def load_model(path, content_hash):
+    """The CachedModel of the file at path, parsed only if no session has it in the cache"""
+    model = get_model_cache().get(content_hash)
+    if model is not None:
+        return model
+    with _model_cache_lock:
+        loading_lock = _loading_locks.setdefault(content_hash, threading.Lock())
+    with loading_lock:
+        model = get_model_cache().get(content_hash)
+        if model is None:
+            model = CachedModel(content_hash, ifcopenshell.open(path), os.path.getsize(path))
+            get_model_cache().put(content_hash, model, size=model.get_size())
+    with _model_cache_lock:
+        _loading_locks.pop(content_hash, None)
+    return model
@@ -0,0 +1,100 @@
+import functools
+import numpy as np
+import pandas as pd
+
+
+# ========== Dung Beetle columns of the Deconstruction Grid ==========
+
+# Source columns are matched by substring, in the order they appear in the extracted DataFrame
+VOLUME_MATCHERS = ["NetVolume", "Volume (Net)", "Volumen (netto)"]
+MASS_MATCHERS = ["Mass"]
+# All CO2 columns come before all Embodied Carbon columns
+CARBON_MATCHERS = [["CO2"], ["Embodied Carbon"]]
+CONNECTION_TYPE_COLUMN = "PropertySets.D4D.10_Connection_type"
+MATERIAL_CONNECTION_TYPE_COLUMN = "MaterialPsets.Connection type"
+# (structure type column, value of profiled elements, column with the profile's materials), in English and German ArchiCAD exports
+PROFILE_MATERIAL_COLUMNS = [
+    ("PropertySets.ArchiCADProperties.Structure Type", "Complex Profile", "PropertySets.ArchiCADProperties.Building Materials (All)"),
+    ("PropertySets.ArchiCADProperties.Struktur-Typ", "Profil", "PropertySets.ArchiCADProperties.Baustoffe (Alle)"),
+]
+# Dung Beetle columns and where they are inserted
+DUNG_BEETLE_COLUMNS = [("Volume", 9), ("Mass", 10), ("Embodied_CO2", 11)]
+CARBON_UNIT_PATTERN = r"\s*\(kgCO₂(?:/kg)?\)\s*$"
+NOT_DEFINED = "Not defined"
+
+
+def get_matching_columns(columns, matchers, exclude=()):
+    return [column for column in columns if column not in exclude and any(matcher in column for matcher in matchers)]
+
+
+@functools.lru_cache(maxsize=256)
+def get_normalization_plan(columns):
+    """
+    Resolve once per column layout (a tuple of column names) which columns the Volume, Mass,
+    Embodied_CO2, Connection_type and Material columns are built from.
+    Files exported with the same template share the plan.
+    """
+    targets = {target for target, _ in DUNG_BEETLE_COLUMNS} | {"Connection_type"}
+    profile_material = next(
+        (columns_and_value for columns_and_value in PROFILE_MATERIAL_COLUMNS if columns_and_value[0] in columns), None
+        )
+    return {
+        "Volume": get_matching_columns(columns, VOLUME_MATCHERS, targets),
+        "Mass": get_matching_columns(columns, MASS_MATCHERS, targets),
+        "Embodied_CO2": [column for matchers in CARBON_MATCHERS for column in get_matching_columns(columns, matchers, targets)],
+        # The D4D property is renamed to Connection_type, the material's connection type fills its gaps
+        "Connection_type": [column for column in columns if CONNECTION_TYPE_COLUMN in column]
+        + [column for column in columns if column == MATERIAL_CONNECTION_TYPE_COLUMN],
+        "profile_material": profile_material if profile_material and profile_material[2] in columns else None,
+    }
+
+
+def coalesce(df, source_columns):
+    """First non-null value of the source columns in every row"""
+    if not source_columns:
+        return pd.Series(np.nan, index=df.index, dtype=object)
+    if len(source_columns) == 1:
+        return df[source_columns[0]].astype(object)
+    return df[source_columns].astype(object).bfill(axis=1).iloc[:, 0]
+
+
+def parse_numbers(values, unit_pattern=None):
+    """Numbers from numeric or text values (e.g. "12.5 (kgCO₂)"), blanks and unparsable text become NaN"""
+    text = values.astype(str)
+    if unit_pattern:
+        text = text.str.replace(unit_pattern, "", regex=True)
+    return pd.to_numeric(text.str.strip(), errors="coerce")
+
+
+def normalize_element_dataframe(df):
+    """
+    Add the Dung Beetle columns to a DataFrame of ifchelper object data: Volume, Mass (kg, 0 if unknown),
+    Embodied_CO2 (kgCO₂, 0 if unknown) and Connection_type ("Not defined" if unknown), and clean up Material.
+    """
+    plan = get_normalization_plan(tuple(df.columns))
+
+    values = {
+        "Volume": parse_numbers(coalesce(df, plan["Volume"])),
+        "Mass": parse_numbers(coalesce(df, plan["Mass"])).fillna(0),
+        "Embodied_CO2": parse_numbers(coalesce(df, plan["Embodied_CO2"]), CARBON_UNIT_PATTERN).fillna(0),
+    }
+
+    connection_sources = plan["Connection_type"]
+    connection_type = coalesce(df, connection_sources).fillna(NOT_DEFINED)
+    if connection_sources and CONNECTION_TYPE_COLUMN in connection_sources[0]:
+        df = df.rename(columns={connection_sources[0]: "Connection_type"})
+        df["Connection_type"] = connection_type
+    else:
+        df = df.assign(Connection_type=connection_type)
+
+    for target, position in DUNG_BEETLE_COLUMNS:
+        df.insert(min(position, len(df.columns)), target, values[target])
+
+    material = df["Material"].astype(object)
+    blank = material.isna() | material.astype(str).str.strip().eq("")
+    df["Material"] = material.astype(str).mask(blank, NOT_DEFINED)
+    if plan["profile_material"]:
+        structure_type_column, profile_value, materials_column = plan["profile_material"]
+        profiled = df[structure_type_column] == profile_value
+        df.loc[profiled, "Material"] = df.loc[profiled, materials_column]
+    return df
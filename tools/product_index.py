@@ -0,0 +1,129 @@
+import itertools
+import numpy as np
+import pandas as pd
+import sys
+
+
+# ========== Count of identical products ==========
+
+# Products are the same if they match on all of these columns, missing values match missing values
+PRODUCT_MATCH_COLUMNS = ["Manufacturer", "Model", "Article number", "Length_[cm]", "Width_[cm]", "Height_[cm]"]
+
+
+def normalize_key_value(value):
+    # NaN, None and pd.NA all mean the value is missing and are equal to each other
+    if value is None or (np.ndim(value) == 0 and pd.isna(value)):
+        return None
+    return value
+
+
+class GroupCountIndex:
+    """
+    Number of rows of a table per combination of values of columns, built once when the table
+    is loaded. count() of a selected row is a dictionary lookup and row_counts holds the count
+    of every row of the table, in the table's order.
+    """
+
+    def __init__(self, df, columns=PRODUCT_MATCH_COLUMNS):
+        self.columns = [column for column in columns if column in df.columns]
+        if self.columns and len(df):
+            group_ids = df.groupby(self.columns, dropna=False, sort=False).ngroup().to_numpy()
+            self.row_counts = np.bincount(group_ids)[group_ids]
+        else:
+            self.row_counts = np.full(len(df), len(df), dtype=np.int64)
+        # duplicated() compares missing values as equal, one row per group is enough to get its key
+        first_rows = ~df.duplicated(subset=self.columns) if self.columns else np.arange(len(df)) == 0
+        keys = df.loc[first_rows, self.columns].itertuples(index=False, name=None)
+        self.counts = {
+            tuple(normalize_key_value(value) for value in key): int(count)
+            for key, count in zip(keys, self.row_counts[np.asarray(first_rows)])
+        }
+
+    def get_key(self, row):
+        return tuple(normalize_key_value(row.get(column)) for column in self.columns)
+
+    def count(self, row):
+        """Number of rows matching row (a dict, e.g. a row selected in AgGrid) on all columns"""
+        return self.counts.get(self.get_key(row), 0)
+
+    def memory_usage(self, deep=True):
+        # Used by cache.get_size
+        return self.row_counts.nbytes + sys.getsizeof(self.counts) + sum(sys.getsizeof(key) for key in self.counts)
+
+
+# ========== Search by dimensions within a tolerance ==========
+
+DIMENSION_COLUMNS = ["Length_[cm]", "Width_[cm]", "Height_[cm]"]
+DISTANCE_COLUMN = "Distance_[cm]"
+DIMENSION_CELL_SIZE = 5.0
+
+
+class DimensionIndex:
+    """
+    Grid-bucket index over the dimensions of the products of a table. The dimensions of every
+    product are sorted from largest to smallest, so a door of 90 x 210 cm is found however
+    it was modelled, and products are bucketed in cubic cells of cell_size cm.
+    A tolerance query only looks at the products of the cells within the tolerance.
+    """
+
+    def __init__(self, df, columns=DIMENSION_COLUMNS, cell_size=DIMENSION_CELL_SIZE):
+        self.columns = [column for column in columns if column in df.columns]
+        self.cell_size = cell_size
+        dimensions = df[self.columns].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+        # Largest first, missing dimensions are sorted last and never match
+        self.dimensions = -np.sort(-dimensions, axis=1)
+        self.cells = {}
+        complete_rows = np.flatnonzero(~np.isnan(self.dimensions).any(axis=1))
+        if len(complete_rows) and self.columns:
+            cell_coordinates = np.floor(self.dimensions[complete_rows] / cell_size).astype(np.int64)
+            unique_cells, inverse = np.unique(cell_coordinates, axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            boundaries = np.cumsum(np.bincount(inverse))[:-1]
+            cell_rows = np.split(complete_rows[np.argsort(inverse, kind="stable")], boundaries)
+            self.cells = dict(zip(map(tuple, unique_cells.tolist()), cell_rows))
+
+    def get_candidates(self, query, tolerance):
+        # Rows in the cells overlapping the tolerance box, or all rows if that is more cells than are occupied
+        low = np.floor((query - tolerance) / self.cell_size).astype(np.int64)
+        high = np.floor((query + tolerance) / self.cell_size).astype(np.int64)
+        if np.prod(high - low + 1) > len(self.cells):
+            return np.arange(len(self.dimensions))
+        cells = itertools.product(*[range(start, stop + 1) for start, stop in zip(low.tolist(), high.tolist())])
+        rows = [self.cells[cell] for cell in cells if cell in self.cells]
+        return np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+    def search(self, dimensions, tolerance, limit=None):
+        """
+        Positions of the rows whose dimensions are all within tolerance of dimensions, and their
+        Euclidean distances, nearest first. Fewer dimensions than columns (e.g. 90 x 210 for a door
+        of unknown thickness) are compared with the closest matching dimensions of every product.
+        """
+        query = -np.sort(-np.asarray([dimension for dimension in dimensions if dimension], dtype=float))
+        if not len(query) or len(query) > len(self.columns):
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        if len(query) == len(self.columns):
+            candidates = self.get_candidates(query, tolerance)
+            subsets = [list(range(len(self.columns)))]
+        else:
+            # The query's dimensions can be any of the product's dimensions, in the same order
+            candidates = np.arange(len(self.dimensions))
+            subsets = [list(subset) for subset in itertools.combinations(range(len(self.columns)), len(query))]
+        differences = np.stack([np.abs(self.dimensions[candidates][:, subset] - query) for subset in subsets])
+        # Missing dimensions never match
+        differences = np.where(np.isnan(differences), np.inf, differences)
+        distances = np.sqrt((differences ** 2).sum(axis=2))
+        distances = np.where((differences <= tolerance).all(axis=2), distances, np.inf).min(axis=0)
+        matches = np.flatnonzero(np.isfinite(distances))
+        order = matches[np.argsort(distances[matches], kind="stable")][:limit]
+        return candidates[order], distances[order]
+
+    def search_dataframe(self, df, dimensions, tolerance, limit=None):
+        """Rows of df (the table the index was built from) matching dimensions, nearest first with their distance"""
+        positions, distances = self.search(dimensions, tolerance, limit)
+        results = df.iloc[positions].copy()
+        results.insert(0, DISTANCE_COLUMN, np.round(distances, 1))
+        return results
+
+    def memory_usage(self, deep=True):
+        # Used by cache.get_size
+        return self.dimensions.nbytes + sum(rows.nbytes for rows in self.cells.values()) + sys.getsizeof(self.cells)
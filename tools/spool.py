@@ -0,0 +1,67 @@
+import hashlib
+import os
+import tempfile
+import time
+from tools import model_cache
+
+
+# ========== Spool uploaded IFC files to disk ==========
+
+SPOOL_DIR = os.environ.get("DUNGBEETLE_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "dungbeetle_uploads"))
+# Spool files of sessions that ended without replacing their upload are removed after a day
+SPOOL_MAX_AGE_SECONDS = 24 * 60 * 60
+CHUNK_SIZE = 1024 * 1024
+
+
+def spool_upload(uploaded_file, previous_path=None):
+    """
+    Stream an uploaded file to a spool file in chunks, so the model can be opened by path instead
+    of copying the upload into bytes and a decoded string. Returns the path and the SHA-256 of the
+    content, hashed while copying. The session's previous spool file is removed.
+    """
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    remove_spool_file(previous_path)
+    remove_stale_spool_files()
+    suffix = os.path.splitext(uploaded_file.name)[1] or ".ifc"
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=SPOOL_DIR, suffix=suffix, delete=False) as spool_file:
+        uploaded_file.seek(0)
+        for chunk in iter(lambda: uploaded_file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            spool_file.write(chunk)
+    uploaded_file.seek(0)
+    return spool_file.name, digest.hexdigest()
+
+
+def open_upload(uploaded_file, previous_path=None):
+    """
+    Spool the upload and return its content hash and the spool file path. The file is only parsed
+    if no session has the same content in the model cache. Sessions keep the hash and the path,
+    not the model, so an evicted model is freed: get_session_model() parses it again if needed.
+    """
+    path, content_hash = spool_upload(uploaded_file, previous_path)
+    model_cache.load_model(path, content_hash)
+    return content_hash, path
+
+
+def get_session_model(session):
+    """The model_cache.CachedModel of the session's upload, fetched from the cache on every rerun"""
+    return model_cache.load_model(session["ifc_path"], session["model_hash"])
+
+
+def remove_spool_file(path):
+    if path and os.path.dirname(os.path.abspath(path)) == os.path.abspath(SPOOL_DIR):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_stale_spool_files(max_age_seconds=SPOOL_MAX_AGE_SECONDS):
+    oldest = time.time() - max_age_seconds
+    for entry in os.scandir(SPOOL_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < oldest:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,385 @@
+import abc
+import functools
+import os
+import pathlib
+import shutil
+import threading
+import time
+from collections import namedtuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# ========== Buckets used by Dung Beetle ==========
+
+IFC_PROCESSING_BUCKET = "warehouse_processing_directory"
+TABLE_PROCESSING_BUCKET = "pickles_processing_directory"
+WAREHOUSE_BUCKET = "pickle_warehouse"
+IFC_WAREHOUSE_BUCKET = "ifc_warehouse"
+VIEWER_BUCKET = "streamlit_warehouse"
+
+# DUNGBEETLE_STORAGE selects the backend: "gcs" (default) or "local:<directory>" to run without cloud access
+STORAGE_SETTING = os.environ.get("DUNGBEETLE_STORAGE", "gcs")
+GCS_POOL_SIZE = int(os.environ.get("DUNGBEETLE_GCS_POOL_SIZE", "32"))
+# Range request size of streamed reads, small enough that reading a few Parquet columns downloads little else
+GCS_READ_CHUNK_SIZE = 1024 * 1024
+
+
+# ========== Storage interface ==========
+
+BlobInfo = namedtuple("BlobInfo", ["name", "size", "generation"])
+
+
+class NotFound(Exception):
+    pass
+
+
+class PreconditionFailed(Exception):
+    """The object's generation didn't match if_generation_match (0 means the object must not exist)"""
+    pass
+
+
+class Storage(abc.ABC):
+    """
+    Object storage of named buckets. Writes return the new generation of the object and
+    accept if_generation_match, so read-modify-write cycles (e.g. table manifests) can be made safe.
+    """
+
+    @abc.abstractmethod
+    def put(self, bucket, name, data, content_type=None, if_generation_match=None):
+        """Store bytes, a string or the content of a binary file object"""
+        pass
+
+    def put_file(self, bucket, name, path, content_type=None):
+        with open(path, "rb") as source:
+            return self.put(bucket, name, source, content_type=content_type)
+
+    @abc.abstractmethod
+    def get(self, bucket, name, if_generation_match=None):
+        pass
+
+    def get_file(self, bucket, name, path):
+        with self.open(bucket, name) as source, open(path, "wb") as destination:
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+        return path
+
+    @abc.abstractmethod
+    def open(self, bucket, name):
+        """Binary file object streaming the object's content"""
+        pass
+
+    @abc.abstractmethod
+    def stat(self, bucket, name):
+        """BlobInfo of the object, None if it doesn't exist"""
+        pass
+
+    def exists(self, bucket, name):
+        return self.stat(bucket, name) is not None
+
+    @abc.abstractmethod
+    def list(self, bucket, prefix=""):
+        """BlobInfo of all objects whose name starts with prefix, sorted by name"""
+        pass
+
+    @abc.abstractmethod
+    def copy(self, bucket, name, destination_bucket, destination_name=None):
+        pass
+
+    def move(self, bucket, name, destination_bucket, destination_name=None):
+        self.copy(bucket, name, destination_bucket, destination_name)
+        self.delete(bucket, name)
+
+    @abc.abstractmethod
+    def delete(self, bucket, name):
+        pass
+
+    @abc.abstractmethod
+    def public_url(self, bucket, name):
+        """URL the object can be downloaded from without credentials"""
+        pass
+
+    def bucket(self, bucket):
+        return Bucket(self, bucket)
+
+
+class Bucket:
+    """A Storage bound to one bucket: bucket.get(name) is storage.get(bucket_name, name)"""
+
+    METHODS = {"put", "put_file", "get", "get_file", "open", "stat", "exists", "list", "copy", "move", "delete", "public_url"}
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+
+    def __getattr__(self, method):
+        if method not in Bucket.METHODS:
+            raise AttributeError(method)
+        return functools.partial(getattr(self.storage, method), self.name)
+
+
+# ========== Google Cloud Storage backend ==========
+
+
+class GCSStorage(Storage):
+    """
+    Google Cloud Storage through a single client. All requests share one HTTP session
+    whose connection pool is large enough for concurrent uploads and Streamlit sessions.
+    """
+
+    def __init__(self, credentials=None, pool_size=GCS_POOL_SIZE):
+        from google.api_core import exceptions
+        from google.cloud import storage as gcs
+        self.exceptions = exceptions
+        self.translated_exceptions = (exceptions.NotFound, exceptions.PreconditionFailed)
+        from requests.adapters import HTTPAdapter
+        if credentials:
+            self.client = gcs.Client(project=getattr(credentials, "project_id", None), credentials=credentials)
+        else:
+            self.client = gcs.Client()
+        # The client's own session has credentials scoped for Cloud Storage, only its connection pool is enlarged
+        self.client._http.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        self.buckets = {}
+
+    def get_bucket(self, bucket):
+        if bucket not in self.buckets:
+            self.buckets[bucket] = self.client.bucket(bucket)
+        return self.buckets[bucket]
+
+    def blob(self, bucket, name):
+        return self.get_bucket(bucket).blob(name)
+
+    def translate(self, error):
+        if isinstance(error, self.exceptions.NotFound):
+            return NotFound(str(error))
+        return PreconditionFailed(str(error))
+
+    def put(self, bucket, name, data, content_type=None, if_generation_match=None):
+        blob = self.blob(bucket, name)
+        try:
+            if isinstance(data, (bytes, bytearray, str)):
+                blob.upload_from_string(data, content_type=content_type, if_generation_match=if_generation_match)
+            else:
+                blob.upload_from_file(data, content_type=content_type, if_generation_match=if_generation_match)
+        except self.translated_exceptions as error:
+            raise self.translate(error)
+        return blob.generation
+
+    def put_file(self, bucket, name, path, content_type=None):
+        blob = self.blob(bucket, name)
+        try:
+            blob.upload_from_filename(path, content_type=content_type)
+        except self.translated_exceptions as error:
+            raise self.translate(error)
+        return blob.generation
+
+    def get(self, bucket, name, if_generation_match=None):
+        try:
+            return self.blob(bucket, name).download_as_bytes(if_generation_match=if_generation_match)
+        except self.translated_exceptions as error:
+            raise self.translate(error)
+
+    def get_file(self, bucket, name, path):
+        try:
+            self.blob(bucket, name).download_to_filename(path)
+        except self.translated_exceptions as error:
+            raise self.translate(error)
+        return path
+
+    def open(self, bucket, name):
+        blob = self.blob(bucket, name)
+        try:
+            # The size is needed to seek from the end (e.g. to a Parquet footer), and a missing object fails here
+            blob.reload()
+        except self.translated_exceptions as error:
+            raise self.translate(error)
+        return blob.open("rb", chunk_size=GCS_READ_CHUNK_SIZE)
+
+    def stat(self, bucket, name):
+        blob = self.get_bucket(bucket).get_blob(name)
+        return BlobInfo(blob.name, blob.size, blob.generation) if blob is not None else None
+
+    def list(self, bucket, prefix=""):
+        for blob in self.client.list_blobs(bucket, prefix=prefix or None):
+            yield BlobInfo(blob.name, blob.size, blob.generation)
+
+    def copy(self, bucket, name, destination_bucket, destination_name=None):
+        blob = self.blob(bucket, name)
+        new_blob = self.blob(destination_bucket, destination_name or name)
+        # Large objects are rewritten in several calls
+        token = None
+        try:
+            while True:
+                token, _, _ = new_blob.rewrite(blob, token=token)
+                if token is None:
+                    break
+        except self.translated_exceptions as error:
+            raise self.translate(error)
+
+    def delete(self, bucket, name):
+        try:
+            self.blob(bucket, name).delete()
+        except self.translated_exceptions as error:
+            raise self.translate(error)
+
+    def public_url(self, bucket, name):
+        blob = self.blob(bucket, name)
+        blob.make_public()
+        return blob.public_url
+
+
+# ========== Local directory backend ==========
+
+
+class LocalStorage(Storage):
+    """
+    Buckets are directories below root, objects are files. Writes go through a temporary
+    file and an atomic rename, generations are kept in the file's modification time, and
+    generation preconditions are checked under a lock (also across processes where fcntl exists).
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(self.root, ".locks"), exist_ok=True)
+
+    def path(self, bucket, name):
+        bucket_path = os.path.join(self.root, bucket)
+        path = os.path.normpath(os.path.join(bucket_path, *name.split("/")))
+        if not path.startswith(bucket_path + os.sep):
+            raise ValueError(f"Object name outside of bucket {bucket}: {name}")
+        return path
+
+    def bucket_lock(self, bucket):
+        return BucketLock(self.lock, os.path.join(self.root, ".locks", f"{bucket}.lock"))
+
+    def get_generation(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def put(self, bucket, name, data, content_type=None, if_generation_match=None):
+        path = self.path(bucket, name)
+        if name.endswith("/"):
+            # Folder placeholder objects
+            os.makedirs(path, exist_ok=True)
+            return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = os.path.join(os.path.dirname(path), f".tmp-{os.getpid()}-{threading.get_ident()}-{os.path.basename(path)}")
+        with open(temp_path, "wb") as destination:
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            if isinstance(data, (bytes, bytearray)):
+                destination.write(data)
+            else:
+                shutil.copyfileobj(data, destination, 1024 * 1024)
+        with self.bucket_lock(bucket):
+            current_generation = self.get_generation(path)
+            if if_generation_match is not None and current_generation != if_generation_match:
+                os.remove(temp_path)
+                raise PreconditionFailed(f"{bucket}/{name} is at generation {current_generation}, not {if_generation_match}")
+            # Generations strictly increase, even for writes within the file system's timestamp resolution
+            generation = max(time.time_ns(), current_generation + 1)
+            os.utime(temp_path, ns=(generation, generation))
+            os.replace(temp_path, path)
+        return generation
+
+    def get(self, bucket, name, if_generation_match=None):
+        path = self.path(bucket, name)
+        try:
+            with open(path, "rb") as source:
+                if if_generation_match is not None and os.fstat(source.fileno()).st_mtime_ns != if_generation_match:
+                    raise PreconditionFailed(f"{bucket}/{name} is not at generation {if_generation_match}")
+                return source.read()
+        except FileNotFoundError:
+            raise NotFound(f"{bucket}/{name}")
+
+    def open(self, bucket, name):
+        try:
+            return open(self.path(bucket, name), "rb")
+        except FileNotFoundError:
+            raise NotFound(f"{bucket}/{name}")
+
+    def stat(self, bucket, name):
+        path = self.path(bucket, name)
+        if not os.path.isfile(path):
+            return None
+        file_stat = os.stat(path)
+        return BlobInfo(name, file_stat.st_size, file_stat.st_mtime_ns)
+
+    def list(self, bucket, prefix=""):
+        bucket_path = os.path.join(self.root, bucket)
+        infos = []
+        for directory, _, file_names in os.walk(bucket_path):
+            for file_name in file_names:
+                if file_name.startswith(".tmp-"):
+                    continue
+                path = os.path.join(directory, file_name)
+                name = os.path.relpath(path, bucket_path).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    file_stat = os.stat(path)
+                    infos.append(BlobInfo(name, file_stat.st_size, file_stat.st_mtime_ns))
+        return iter(sorted(infos))
+
+    def copy(self, bucket, name, destination_bucket, destination_name=None):
+        with self.open(bucket, name) as source:
+            self.put(destination_bucket, destination_name or name, source)
+
+    def delete(self, bucket, name):
+        try:
+            os.remove(self.path(bucket, name))
+        except FileNotFoundError:
+            raise NotFound(f"{bucket}/{name}")
+
+    def public_url(self, bucket, name):
+        return pathlib.Path(self.path(bucket, name)).as_uri()
+
+
+class BucketLock:
+    def __init__(self, thread_lock, lock_path):
+        self.thread_lock = thread_lock
+        self.lock_path = lock_path
+        self.lock_file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if fcntl is not None:
+            self.lock_file = open(self.lock_path, "a")
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+        self.thread_lock.release()
+
+
+# ========== Process-wide storage ==========
+
+_storage = None
+
+
+def create_storage(setting=STORAGE_SETTING, credentials=None):
+    if setting.startswith("local:"):
+        return LocalStorage(setting[len("local:"):])
+    if setting != "gcs":
+        raise ValueError(f"Unknown DUNGBEETLE_STORAGE backend: {setting}")
+    return GCSStorage(credentials)
+
+
+def get_storage(credentials=None):
+    """The storage backend shared by all pages and sessions of the process"""
+    global _storage
+    if _storage is None:
+        _storage = create_storage(STORAGE_SETTING, credentials)
+    return _storage
+
+
+def set_storage(storage):
+    global _storage
+    _storage = storage
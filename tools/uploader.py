@@ -0,0 +1,128 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tools import storage
+
+
+# ========== Concurrent uploads of extracted files ==========
+
+UPLOAD_CONCURRENCY = int(os.environ.get("DUNGBEETLE_UPLOAD_CONCURRENCY", "8"))
+UPLOAD_RETRIES = 5
+UPLOAD_BACKOFF_SECONDS = 0.5
+
+
+class UploadPipeline:
+    """
+    Bounded producer/consumer uploader: submit() hands a local file to a pool of upload threads
+    and only blocks while max_pending files are already waiting, so extraction keeps running
+    while earlier files are on the network and the files on disk stay bounded.
+    Failed uploads are retried with exponential backoff, uploaded files are deleted locally.
+    """
+
+    def __init__(self, storage_backend, bucket_name, concurrency=UPLOAD_CONCURRENCY, max_pending=None,
+                 retries=UPLOAD_RETRIES, backoff_seconds=UPLOAD_BACKOFF_SECONDS, delete_uploaded=True):
+        self.storage_backend = storage_backend
+        self.bucket_name = bucket_name
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.delete_uploaded = delete_uploaded
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="upload")
+        self.pending = threading.BoundedSemaphore(max_pending or concurrency * 4)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.retried = 0
+        self.failures = []
+        self.start_time = time.monotonic()
+
+    def submit(self, local_path, blob_name):
+        self.pending.acquire()
+        with self.lock:
+            self.submitted += 1
+        future = self.executor.submit(self.upload, local_path, blob_name)
+        future.add_done_callback(lambda _: self.pending.release())
+        return future
+
+    def upload(self, local_path, blob_name):
+        # Every submitted file ends up uploaded or failed, otherwise wait() would never return
+        try:
+            return self.upload_with_retries(local_path, blob_name)
+        except Exception as error:
+            self.add_failure(blob_name, error)
+            return False
+
+    def upload_with_retries(self, local_path, blob_name):
+        size = os.path.getsize(local_path)
+        for attempt in range(self.retries + 1):
+            try:
+                self.storage_backend.put_file(self.bucket_name, blob_name, local_path)
+                break
+            except (storage.NotFound, storage.PreconditionFailed) as error:
+                # Retrying can't fix these
+                self.add_failure(blob_name, error)
+                return False
+            except Exception as error:
+                if attempt == self.retries:
+                    self.add_failure(blob_name, error)
+                    return False
+                with self.lock:
+                    self.retried += 1
+                # Exponential backoff with jitter, so parallel retries don't hit the service at once
+                time.sleep(self.backoff_seconds * 2 ** attempt * (1 + random.random()))
+        if self.delete_uploaded:
+            os.remove(local_path)
+        with self.lock:
+            self.uploaded += 1
+            self.uploaded_bytes += size
+        return True
+
+    def add_failure(self, blob_name, error):
+        with self.lock:
+            self.failures.append((blob_name, repr(error)))
+
+    def wait(self, timeout=None):
+        """Wait until all submitted uploads are finished, returns False if the timeout ran out first"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            progress = self.get_progress()
+            if progress["uploaded"] + progress["failed"] >= progress["submitted"]:
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        return self.get_progress()
+
+    def get_progress(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.start_time, 1e-9)
+            return {
+                "submitted": self.submitted,
+                "uploaded": self.uploaded,
+                "failed": len(self.failures),
+                "retried": self.retried,
+                "bytes": self.uploaded_bytes,
+                "elapsed": elapsed,
+                "files_per_second": self.uploaded / elapsed,
+                "megabytes_per_second": self.uploaded_bytes / elapsed / (1024 * 1024),
+            }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def format_progress(progress):
+    return (
+        f"{progress['uploaded']} of {progress['submitted']} files uploaded"
+        f" ({progress['files_per_second']:.1f} files/s, {progress['megabytes_per_second']:.2f} MB/s)"
+        + (f", {progress['retried']} retries" if progress["retried"] else "")
+        + (f", {progress['failed']} failed" if progress["failed"] else "")
+    )
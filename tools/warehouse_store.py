@@ -0,0 +1,393 @@
+import hashlib
+import io
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import threading
+from datetime import datetime
+from tools.storage import NotFound, PreconditionFailed
+
+
+# ========== Columnar warehouse tables (Parquet) ==========
+
+TABLE_SUFFIX = ".parquet"
+ROW_GROUP_SIZE = 10000
+
+
+def table_name(entity):
+    return f"wh_{entity}{TABLE_SUFFIX}"
+
+
+def prepare_dataframe_for_parquet(df):
+    """
+    Parquet columns need a single type. Object columns mixing numbers and strings
+    (e.g. a property written as text in one model and as a number in another) are stored as strings.
+    """
+    df = df.copy()
+    df.columns = [str(column) for column in df.columns]
+    for column in df.columns:
+        if df[column].dtype != object:
+            continue
+        values = df[column].dropna()
+        value_types = set(map(type, values))
+        if len(value_types) <= 1 and value_types != {dict} and value_types != {list} and value_types != {tuple}:
+            continue
+        if value_types <= {int, float}:
+            df[column] = df[column].astype("float64")
+        else:
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    return df
+
+
+def write_table(df, destination=None):
+    """
+    Write a DataFrame as a zstd compressed Parquet table. Returns the bytes when no
+    destination path or file object is given.
+    """
+    table = pa.Table.from_pandas(prepare_dataframe_for_parquet(df), preserve_index=False)
+    buffer = destination if destination is not None else io.BytesIO()
+    pq.write_table(table, buffer, compression="zstd", row_group_size=ROW_GROUP_SIZE)
+    if destination is None:
+        return buffer.getvalue()
+
+
+def read_table(source, columns=None, filters=None):
+    """
+    Read a Parquet table from a path, bytes or seekable file object. Only the requested columns
+    are read from a path or file object (missing ones are skipped) and filters like [("Country", "==", "Schweiz")]
+    are pushed down to skip whole row groups.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = pa.BufferReader(source)
+    parquet_file = pq.ParquetFile(source)
+    if columns is not None:
+        available_columns = set(parquet_file.schema_arrow.names)
+        columns = [column for column in columns if column in available_columns]
+    if filters:
+        table = pq.read_table(source, columns=columns, filters=filters)
+    else:
+        table = parquet_file.read(columns=columns)
+    return table.to_pandas()
+
+
+def read_table_columns(source):
+    if isinstance(source, (bytes, bytearray)):
+        source = pa.BufferReader(source)
+    return pq.ParquetFile(source).schema_arrow.names
+
+
+# ========== Append-only warehouse tables: delta segments + manifest ==========
+
+MANIFEST_NAME = "manifest.json"
+COMPACTION_SEGMENT_COUNT = 8
+COMPACTION_DELTA_BYTES = 64 * 1024 * 1024
+
+
+def manifest_blob_name(entity):
+    return f"wh_{entity}/{MANIFEST_NAME}"
+
+
+def segment_blob_name(entity, segment_data):
+    # Segments are content-addressed: identical data is stored once and never rewritten
+    return f"wh_{entity}/segment_{hashlib.sha256(segment_data).hexdigest()}{TABLE_SUFFIX}"
+
+
+def upload_segment(bucket, entity, segment_data):
+    segment_name = segment_blob_name(entity, segment_data)
+    if not bucket.exists(segment_name):
+        bucket.put(segment_name, segment_data, content_type="application/octet-stream")
+    return segment_name
+
+
+def load_manifest(bucket, entity):
+    """
+    Return the manifest of a warehouse table and the generation it was read at (0 if it doesn't exist).
+    A single-file wh_<entity>.parquet table from before the manifests is adopted as the first segment.
+    bucket is a tools.storage.Bucket.
+    """
+    while True:
+        info = bucket.stat(manifest_blob_name(entity))
+        if info is None:
+            break
+        try:
+            return json.loads(bucket.get(info.name, if_generation_match=info.generation)), info.generation
+        except (NotFound, PreconditionFailed):
+            # Rewritten or deleted between reading its generation and its content
+            continue
+    manifest = {"entity": entity, "version": 0, "segments": []}
+    legacy_info = bucket.stat(table_name(entity))
+    if legacy_info is not None:
+        manifest["segments"].append({"name": legacy_info.name, "rows": None, "bytes": legacy_info.size})
+    return manifest, 0
+
+
+def save_manifest(bucket, entity, manifest, generation):
+    """
+    Write the manifest only if nobody else changed it since it was read at this generation.
+    Raises tools.storage.PreconditionFailed otherwise.
+    """
+    manifest["version"] += 1
+    return bucket.put(
+        manifest_blob_name(entity), json.dumps(manifest, indent=1), content_type="application/json", if_generation_match=generation
+        )
+
+
+def append_segment(bucket, entity, df, retries=5, tombstones=None):
+    """
+    Write df as a new immutable segment and add it to the table's manifest. tombstones is a list
+    of (Project ID, Global ID) whose rows in the existing segments are removed or replaced by df.
+    """
+    segment = None
+    if df is not None and len(df):
+        segment_data = write_table(df)
+        segment = {"name": upload_segment(bucket, entity, segment_data), "rows": len(df), "bytes": len(segment_data)}
+    for attempt in range(retries):
+        manifest, generation = load_manifest(bucket, entity)
+        if tombstones:
+            # Rows of these elements are hidden in every segment before this point
+            manifest.setdefault("tombstones", []).append(
+                {"before_segment": len(manifest["segments"]), "keys": [list(map(str, key)) for key in tombstones]}
+                )
+        if segment:
+            manifest["segments"].append(segment)
+        try:
+            save_manifest(bucket, entity, manifest, generation)
+            return manifest
+        except PreconditionFailed:
+            continue
+    raise RuntimeError(f"Could not update the manifest of wh_{entity}, it keeps changing")
+
+
+# Columns identifying an element's rows, used by tombstones
+TOMBSTONE_KEY_COLUMNS = ["Project ID", "Global ID"]
+
+
+def apply_tombstones(df, tombstones, segment_position):
+    """Drop the rows of df (read from the segment at segment_position) that a later tombstone removed"""
+    keys = set()
+    for tombstone in tombstones:
+        if tombstone["before_segment"] > segment_position:
+            keys.update("\x1f".join(key) for key in tombstone["keys"])
+    if not keys or not set(TOMBSTONE_KEY_COLUMNS) <= set(df.columns):
+        return df
+    row_keys = df[TOMBSTONE_KEY_COLUMNS[0]].astype(str) + "\x1f" + df[TOMBSTONE_KEY_COLUMNS[1]].astype(str)
+    return df[~row_keys.isin(keys)]
+
+
+def read_segment(bucket, segment_name, columns=None, filters=None):
+    # Read through a seekable stream, so only the footer and the column chunks of the requested columns are downloaded
+    with bucket.open(segment_name) as source:
+        return read_table(source, columns=columns, filters=filters)
+
+
+def read_warehouse_table(bucket, entity, columns=None, filters=None, retries=3):
+    """Union of all segments of a warehouse table, reading only the requested columns and row groups"""
+    for attempt in range(retries):
+        manifest, _ = load_manifest(bucket, entity)
+        tombstones = manifest.get("tombstones", [])
+        read_columns = columns
+        if tombstones and columns is not None:
+            read_columns = list(columns) + [column for column in TOMBSTONE_KEY_COLUMNS if column not in columns]
+        try:
+            frames = [
+                apply_tombstones(read_segment(bucket, segment["name"], read_columns, filters), tombstones, position)
+                for position, segment in enumerate(manifest["segments"])
+            ]
+            break
+        except NotFound:
+            # A compaction replaced the segments after the manifest was read, a segment missing every time is really gone
+            if attempt == retries - 1:
+                raise
+    if not frames:
+        return pd.DataFrame(columns=columns or [])
+    df = pd.concat(frames, ignore_index=True)
+    if read_columns is not columns:
+        df = df.drop(columns=[column for column in read_columns if column not in columns and column in df.columns])
+    return df
+
+
+def get_table_version(bucket, entity):
+    """
+    Cheap version of a warehouse table: the generation of its manifest, read from the object
+    metadata only. Tables without a manifest yet use the generation of their single Parquet file.
+    """
+    info = bucket.stat(manifest_blob_name(entity)) or bucket.stat(table_name(entity))
+    return info.generation if info is not None else 0
+
+
+def list_warehouse_tables(bucket):
+    """Entity names of all warehouse tables, with or without a manifest"""
+    entities = set()
+    for info in bucket.list(prefix="wh_"):
+        if info.name.endswith("/" + MANIFEST_NAME):
+            entities.add(info.name[len("wh_"):-len("/" + MANIFEST_NAME)])
+        elif "/" not in info.name and info.name.endswith(TABLE_SUFFIX):
+            entities.add(info.name[len("wh_"):-len(TABLE_SUFFIX)])
+    return sorted(entities)
+
+
+def needs_compaction(manifest):
+    delta_segments = manifest["segments"][1:]
+    return (
+        len(manifest["segments"]) + len(manifest.get("tombstones", [])) >= COMPACTION_SEGMENT_COUNT
+        or sum(segment["bytes"] or 0 for segment in delta_segments) >= COMPACTION_DELTA_BYTES
+        )
+
+
+def is_compaction_current(manifest, segments, tombstones):
+    """Whether manifest still starts with the segments and tombstones a compaction folded"""
+    return (
+        [segment["name"] for segment in manifest["segments"][:len(segments)]] == [segment["name"] for segment in segments]
+        and manifest.get("tombstones", [])[:len(tombstones)] == tombstones
+        )
+
+
+def compact_table(bucket, entity):
+    """
+    Fold all current segments into one. Segments appended while compacting are kept,
+    the folded ones are only deleted once the new manifest is saved and if no snapshot uses them.
+    Gives up if the manifest no longer starts with the folded segments, e.g. after a concurrent compaction.
+    """
+    manifest, generation = load_manifest(bucket, entity)
+    segments = manifest["segments"]
+    applied_tombstones = manifest.get("tombstones", [])
+    if not segments or (len(segments) < 2 and not applied_tombstones):
+        return manifest
+    compacted_df = pd.concat(
+        [apply_tombstones(read_table(bucket.get(segment["name"])), applied_tombstones, position) for position, segment in enumerate(segments)],
+        ignore_index=True,
+        )
+    segment_data = write_table(compacted_df)
+    segment_name = upload_segment(bucket, entity, segment_data)
+    compacted_names = {segment["name"] for segment in segments}
+    while True:
+        if not is_compaction_current(manifest, segments, applied_tombstones):
+            # Another compaction or a snapshot restore replaced the folded segments, folding them again would duplicate rows
+            if segment_name not in {segment["name"] for segment in manifest["segments"]} | get_snapshot_segment_names(bucket):
+                bucket.delete(segment_name)
+            return manifest
+        # By position: a segment appended while compacting can have the same content, and name, as a folded one
+        new_segments = manifest["segments"][len(segments):]
+        manifest["segments"] = [{"name": segment_name, "rows": len(compacted_df), "bytes": len(segment_data)}] + new_segments
+        # Tombstones added while compacting still apply, the folded segments are now the first one
+        manifest["tombstones"] = [
+            dict(tombstone, before_segment=tombstone["before_segment"] - len(segments) + 1)
+            for tombstone in manifest.get("tombstones", [])[len(applied_tombstones):]
+            ]
+        try:
+            save_manifest(bucket, entity, manifest, generation)
+            break
+        except PreconditionFailed:
+            manifest, generation = load_manifest(bucket, entity)
+    snapshot_segment_names = get_snapshot_segment_names(bucket)
+    live_segment_names = {segment["name"] for segment in manifest["segments"]}
+    for name in compacted_names - snapshot_segment_names - live_segment_names:
+        bucket.delete(name)
+    return manifest
+
+
+def start_background_compaction(bucket, entity):
+    """Compact a table in a background thread if it reached the segment count or size threshold"""
+    manifest, _ = load_manifest(bucket, entity)
+    if not needs_compaction(manifest):
+        return None
+    thread = threading.Thread(target=compact_table, args=(bucket, entity), daemon=True)
+    thread.start()
+    return thread
+
+
+# ========== Warehouse snapshots ==========
+
+SNAPSHOT_PREFIX = "snapshots/"
+
+
+# Content-addressed copies of the other blobs a snapshot restores
+SNAPSHOT_BLOB_PREFIX = "snapshot_blobs/"
+
+
+def save_snapshot_blob(bucket, data):
+    name = f"{SNAPSHOT_BLOB_PREFIX}{hashlib.sha256(data).hexdigest()}"
+    if not bucket.exists(name):
+        bucket.put(name, data)
+    return name
+
+
+def create_snapshot(bucket, label="", blob_prefixes=()):
+    """
+    Record the current manifests of all warehouse tables. Segments are immutable and
+    content-addressed, so a snapshot only stores the list of segments and copies no data.
+    Blobs whose names start with one of blob_prefixes (e.g. the stored fingerprints) are
+    kept as content-addressed copies, so they are restored together with the tables.
+    """
+    created = datetime.now()
+    snapshot = {
+        "created": created.isoformat(timespec="seconds"),
+        "label": label,
+        "tables": {entity: load_manifest(bucket, entity)[0] for entity in list_warehouse_tables(bucket)},
+        "blobs": {
+            info.name: save_snapshot_blob(bucket, bucket.get(info.name))
+            for prefix in blob_prefixes for info in list(bucket.list(prefix=prefix))
+        },
+    }
+    snapshot_name = f"{SNAPSHOT_PREFIX}{created.strftime('%Y%m%d_%H%M%S_%f')}.json"
+    bucket.put(snapshot_name, json.dumps(snapshot, indent=1), content_type="application/json")
+    return snapshot_name
+
+
+def load_snapshot(bucket, snapshot_name):
+    return json.loads(bucket.get(snapshot_name))
+
+
+def list_snapshots(bucket):
+    """Snapshots from newest to oldest, with their creation time, label and row counts per table"""
+    snapshots = []
+    for info in bucket.list(prefix=SNAPSHOT_PREFIX):
+        snapshot = load_snapshot(bucket, info.name)
+        snapshots.append({
+            "name": info.name,
+            "created": snapshot["created"],
+            "label": snapshot.get("label", ""),
+            "tables": {
+                entity: sum(segment["rows"] or 0 for segment in manifest["segments"])
+                for entity, manifest in snapshot["tables"].items()
+            },
+        })
+    return sorted(snapshots, key=lambda snapshot: snapshot["created"], reverse=True)
+
+
+def restore_snapshot(bucket, snapshot_name, blob_prefixes=()):
+    """
+    Point every warehouse table back to the segments it had when the snapshot was taken and put back
+    the blobs below blob_prefixes. Blobs the snapshot doesn't have (e.g. in snapshots taken before
+    blobs were recorded) are deleted, they would describe a state the tables are no longer in.
+    """
+    snapshot = load_snapshot(bucket, snapshot_name)
+    snapshot_blobs = snapshot.get("blobs", {})
+    for prefix in blob_prefixes:
+        for info in list(bucket.list(prefix=prefix)):
+            if info.name not in snapshot_blobs:
+                bucket.delete(info.name)
+    for name, copy_name in snapshot_blobs.items():
+        if any(name.startswith(prefix) for prefix in blob_prefixes):
+            bucket.put(name, bucket.get(copy_name))
+    entities = set(snapshot["tables"]) | set(list_warehouse_tables(bucket))
+    for entity in entities:
+        snapshot_manifest = snapshot["tables"].get(entity, {"segments": []})
+        while True:
+            manifest, generation = load_manifest(bucket, entity)
+            manifest["segments"] = snapshot_manifest["segments"]
+            manifest["tombstones"] = snapshot_manifest.get("tombstones", [])
+            try:
+                save_manifest(bucket, entity, manifest, generation)
+                break
+            except PreconditionFailed:
+                continue
+
+
+def get_snapshot_segment_names(bucket):
+    segment_names = set()
+    for info in bucket.list(prefix=SNAPSHOT_PREFIX):
+        for manifest in load_snapshot(bucket, info.name)["tables"].values():
+            segment_names.update(segment["name"] for segment in manifest["segments"])
+    return segment_names